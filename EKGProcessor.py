@@ -1,23 +1,91 @@
 from collections import deque
-from scipy import signal, interpolate, integrate
+from scipy import signal, integrate
+from ring_buffer import RingBuffer
+from filters import sosfilt_state, sosfilt_chunk
+from pan_tompkins import PanTompkinsDetector
+from hrv_metrics import RollingHRV
+from history import SessionHistory
+import metrics
 import threading
 import numpy as np
 import time
 
+class UpdateNotifier:
+    """Version counter guarded by a condition variable. A producer calls notify() after publishing
+    new data; a consumer sleeps in wait() until the version differs from the one it has seen."""
+
+    def __init__(self):
+        self.version = 0
+        self.notified_at = None # perf_counter() time of the last notify()
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.notified_at = time.perf_counter()
+            self.condition.notify_all()
+
+    def wait(self, seen_version, timeout=1.0):
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != seen_version, timeout)
+            return self.version
+
+def next_iteration(pipeline, notifier, version, loop):
+    """Waits for the next iteration of a processing thread: a new `notifier` version in the event pipeline,
+    one second otherwise. Records how late the iteration starts and returns the version seen."""
+    if pipeline == 'event':
+        new_version = notifier.wait(version)
+        if new_version != version:
+            metrics.LOOP_LAG_SECONDS.labels(loop).observe(time.perf_counter() - notifier.notified_at)
+        return new_version
+    due = time.perf_counter() + 1
+    time.sleep(1)
+    metrics.LOOP_LAG_SECONDS.labels(loop).observe(time.perf_counter() - due)
+    return version
+
+def simpson_weights(x):
+    """Weights w of Simpson's rule over the samples at `x`: integrate.simpson(y, x=x) == w @ y."""
+    return integrate.simpson(np.eye(len(x)), x=x, axis=1)
+
 class SignalProcessor:
-    """Class for processing EKG signal. It filters the signal and stores it in a buffer."""
+    """Class for processing EKG signal. It filters the signal and stores it in a buffer.
+
+    By default a single `channel` is processed. Passing `channels` switches to multi-channel mode:
+    each entry is a channel index or a (channel, reference_channel) pair for a derived lead, all leads
+    are filtered together in one 2-D pass and data_buffer holds one column per lead.
 
-    def __init__(self, inlet, samps_per_chunk=16, sampling_rate=500, buffor_size_seconds=5, hp_params=None, lp_params=None, notch_params=None, mode='online', channel=23):
+    In online mode the time axis is the LSL acquisition time (corrected to the local clock),
+    otherwise it is derived from the sample counter."""
+
+    def __init__(self, inlet, samps_per_chunk=16, sampling_rate=500, buffor_size_seconds=5, hp_params=None, lp_params=None, notch_params=None, mode='online', channel=23, channels=None):
         self.inlet = inlet
         self.samps_per_chunk = samps_per_chunk
         self.sampling_rate = sampling_rate
         self.buffor_size = self.sampling_rate * buffor_size_seconds
-        self.data_buffer = deque(maxlen=self.buffor_size)
-        self.time_buffer = deque(maxlen=self.buffor_size)
-        self.current_time = 0
-        self.channel = channel
+        self.time_correction_timeout = 2.0 # seconds
+        self.channel = channel # online: the column read from the inlet; offline: the lead the inlet provides, if known
         self.mode = mode
 
+        # Leads selection for the multi-channel mode
+        self.leads = channels
+        self.n_leads = 1
+        if self.leads is not None:
+            self.n_leads = len(self.leads)
+            self.lead_pos = np.array([lead[0] if isinstance(lead, (tuple, list)) else lead for lead in self.leads])
+            lead_neg = np.array([lead[1] if isinstance(lead, (tuple, list)) else -1 for lead in self.leads])
+            self.derived_leads = np.flatnonzero(lead_neg >= 0)
+            self.lead_neg = lead_neg[self.derived_leads]
+
+        self.data_buffer = RingBuffer(self.buffor_size, channels=None if self.leads is None else self.n_leads)
+        self.time_buffer = RingBuffer(self.buffor_size)
+        self.sample_count = 0
+        self.session = 0 # incremented whenever the buffers are reset
+
+        # Wall-clock arrival of the recent chunks, indexed by the time of their last sample
+        self.chunk_end_time = RingBuffer(1024)
+        self.chunk_arrival = RingBuffer(1024)
+        self.data_updated = UpdateNotifier()
+
         if self.mode == 'offline':
             print("Running in offline mode")
 
@@ -26,35 +94,58 @@ class SignalProcessor:
 
         # Set filters params
         if hp_params is None:
-            self.hp_params = {'order': 3, 'fc': 0.67, 'rp': 0.5, 'rs': 3}
+            hp_params = {'order': 3, 'fc': 0.67, 'rp': 0.5, 'rs': 3}
         if lp_params is None:    
-            self.lp_params = {'order': 4, 'fc': 150, 'rp': None, 'rs': 3}
+            lp_params = {'order': 4, 'fc': 150, 'rp': None, 'rs': 3}
         if notch_params is None:    
-            self.notch_params = {'f0': 50, 'Q': 10}
+            notch_params = {'f0': 50, 'Q': 10}
+        self.hp_params = hp_params
+        self.lp_params = lp_params
+        self.notch_params = notch_params
 
-        # Initialize filters
-        self.update_filters()
+        # Callbacks receiving every chunk as (new_data, filtered_data, time_data)
+        self.listeners = []
 
-        # Synchronization and threading
+        # Synchronization and threading. data_lock serialises the writers; readers take lock-free
+        # snapshots validated by `sequence`, which is odd while the buffers are being updated
         self.data_lock = threading.Lock()
+        self.sequence = 0
+        self.snapshot_retries = 0
+        self.views = {} # lead -> (sequence, data, time) of the last snapshot, shared by all readers
         self.running = False
 
+        # Initialize filters
+        self.update_filters()
+
+        # Metrics of the acquisition path, resolved once as add_data runs for every chunk
+        self.total_samples = 0
+        self.total_chunks = 0
+        self.lock_wait_metric = metrics.LOCK_WAIT_SECONDS.labels('data')
+        self.filter_metric = metrics.STAGE_SECONDS.labels('filter')
+        self.add_data_metric = metrics.STAGE_SECONDS.labels('add_data')
+        metrics.SAMPLES.set_function(lambda: self.total_samples)
+        metrics.CHUNKS.set_function(lambda: self.total_chunks)
+        metrics.SNAPSHOT_RETRIES.set_function(lambda: self.snapshot_retries)
+        metrics.SAMPLE_RATE.set_function(self.get_sample_rate)
+        metrics.CHUNK_BACKLOG.set_function(self.get_backlog)
+
     def update_filters(self):
-        # High-pass filter
-        self.b_h, self.a_h = signal.iirfilter(self.hp_params['order'], self.hp_params['fc'],
-                                          self.hp_params['rp'], self.hp_params['rs'],
-                                          btype='highpass', ftype='butter', output='ba', fs=self.sampling_rate)
-        self.zi_h = signal.lfilter_zi(self.b_h, self.a_h)
-
-        # Low-pass filter
-        self.b_l, self.a_l = signal.iirfilter(self.lp_params['order'], self.lp_params['fc'],
-                                          self.lp_params['rp'], rs=self.lp_params['rs'],
-                                          btype='lowpass', ftype='butter', output='ba', fs=self.sampling_rate)
-        self.zi_l = signal.lfilter_zi(self.b_l, self.a_l)
-
-        # Notch filter
-        self.b_n, self.a_n = signal.iirnotch(self.notch_params['f0'], Q=self.notch_params['Q'], fs=self.sampling_rate)
-        self.zi_n = signal.lfilter_zi(self.b_n, self.a_n)
+        # High-pass, low-pass and notch filters combined into a single cascade of second-order sections
+        sos_h = signal.iirfilter(self.hp_params['order'], self.hp_params['fc'],
+                                 self.hp_params['rp'], self.hp_params['rs'],
+                                 btype='highpass', ftype='butter', output='sos', fs=self.sampling_rate)
+        sos_l = signal.iirfilter(self.lp_params['order'], self.lp_params['fc'],
+                                 self.lp_params['rp'], rs=self.lp_params['rs'],
+                                 btype='lowpass', ftype='butter', output='sos', fs=self.sampling_rate)
+        b_n, a_n = signal.iirnotch(self.notch_params['f0'], Q=self.notch_params['Q'], fs=self.sampling_rate)
+        sos_n = signal.tf2sos(b_n, a_n)
+
+        sos = np.vstack((sos_h, sos_l, sos_n))
+        zi = sosfilt_state(sos, self.n_leads)
+        # The coefficients and their state are replaced together, so a chunk is never filtered with
+        # the sections of one filter and the state of another
+        with self.data_lock:
+            self.filter_state = (sos, zi)
 
     def set_highpass_params(self, order, fc, rp, rs):
         self.hp_params['order'] = order
@@ -77,42 +168,216 @@ class SignalProcessor:
 
     def add_data_continuously(self):
         while self.running:
+            timestamps = None
             if self.mode == 'online':
-                sample, _ = self.inlet.pull_chunk(timeout=1.0, max_samples=self.samps_per_chunk)
-                if sample:
-                    piece = np.array(sample)[:, self.channel]
+                # LSL writes the chunk straight into the preallocated buffer
+                _, timestamps = self.inlet.pull_chunk(timeout=1.0, max_samples=self.samps_per_chunk, dest_obj=self.pull_buffer)
+                if not timestamps:
+                    continue
+                sample = self.pull_buffer[:len(timestamps)]
+                if self.leads is None:
+                    piece = sample[:, self.channel]
+                else:
+                    piece = self.select_leads(sample)
+                self.update_time_correction()
+                timestamps = np.asarray(timestamps) + self.time_correction
             elif self.mode == 'offline':
-                piece = np.array(next(self.inlet))
+                piece = next(self.inlet, None)
+                if piece is None:
+                    # End of the recording
+                    self.running = False
+                    break
+                if isinstance(piece, tuple):
+                    # A replay source gives the recording's timestamps, and a filter pre-roll after a seek
+                    piece, timestamps, pre_roll = piece
+                    if pre_roll is not None:
+                        if self.leads is not None:
+                            pre_roll = self.select_leads(np.array(pre_roll))
+                        self.restart(pre_roll)
+                piece = np.array(piece)
+                if self.leads is not None:
+                    piece = self.select_leads(piece)
             
-            self.add_data(piece)    
-
-    def add_data(self, new_data):
+            self.add_data(piece, timestamps)    
+
+    def update_time_correction(self):
+        # Offset between the amplifier's and the local LSL clock, refreshed every few seconds. The query runs
+        # on the acquisition thread, so it waits at most time_correction_timeout; an unresponsive outlet
+        # keeps the last offset
+        now = time.monotonic()
+        if now - self.time_correction_updated > 5:
+            from pylsl import TimeoutError as LSLTimeoutError
+            try:
+                self.time_correction = self.inlet.time_correction(timeout=self.time_correction_timeout)
+            except LSLTimeoutError:
+                pass
+            self.time_correction_updated = now
+
+    def get_acquisition_latency(self):
+        """Seconds from the acquisition of the newest sample to now, according to the LSL clock (online mode only)."""
+        if self.mode != 'online':
+            return None
+        from pylsl import local_clock
+        newest = self.read_snapshot(lambda: self.time_buffer.snapshot(1))
+        if not len(newest):
+            return None
+        return local_clock() - newest[0]
+
+    def add_data(self, new_data, timestamps=None):
+        start = time.perf_counter()
         with self.data_lock:
+            locked = time.perf_counter()
             filtered_data = self.filter_data(new_data)
+            filtered = time.perf_counter()
+            self.sequence += 1
             self.data_buffer.extend(filtered_data)
-            for _ in range(len(new_data)):
-                self.current_time += 1 / self.sampling_rate
-                self.time_buffer.append(self.current_time)
 
-    def get_data(self):
-        with self.data_lock:
-            return np.array(self.data_buffer), np.array(self.time_buffer)
+            # Without acquisition timestamps the time is derived from the sample counter,
+            # so rounding errors do not accumulate
+            n = len(filtered_data)
+            if timestamps is None:
+                time_data = (self.sample_count + np.arange(1, n + 1)) / self.sampling_rate
+            else:
+                time_data = np.asarray(timestamps, dtype=np.float64)
+            self.time_buffer.extend(time_data)
+            self.sample_count += n
+            if n:
+                self.chunk_end_time.extend([time_data[-1]])
+                self.chunk_arrival.extend([time.perf_counter()])
+            self.sequence += 1
+        self.data_updated.notify()
+
+        self.total_samples += n
+        self.total_chunks += 1
+        self.lock_wait_metric.observe(locked - start)
+        self.filter_metric.observe(filtered - locked)
+        self.add_data_metric.observe(time.perf_counter() - start)
+
+        # Listeners are called outside the lock, so they may read the buffers themselves
+        for listener in self.listeners:
+            listener(new_data, filtered_data, time_data)
+
+    def read_snapshot(self, read):
+        """Result of `read` (copies of the buffers) taken while no chunk was being written. Readers never
+        block the writer: a copy that overlapped a write is thrown away and taken again."""
+        while True:
+            sequence = self.sequence
+            if not sequence & 1:
+                result = read()
+                if self.sequence == sequence:
+                    return result
+            self.snapshot_retries += 1
+            time.sleep(0)
+
+    def arrival_time(self, t):
+        """perf_counter() time at which the sample with timestamp `t` was added."""
+        chunk_end_time, chunk_arrival = self.read_snapshot(
+            lambda: (self.chunk_end_time.snapshot(), self.chunk_arrival.snapshot()))
+        index = np.searchsorted(chunk_end_time, t)
+        if index == len(chunk_end_time):
+            return time.perf_counter()
+        return chunk_arrival[index]
+
+    def get_sample_rate(self):
+        """Samples per second added over the recent chunks, None before there are two chunks."""
+        n = min(len(self.chunk_arrival), self.sample_count // max(self.samps_per_chunk, 1))
+        if n < 2:
+            return None
+        arrival = self.read_snapshot(lambda: self.chunk_arrival.snapshot(n))
+        if len(arrival) < 2 or arrival[-1] <= arrival[0]:
+            return None
+        return (len(arrival) - 1) * self.samps_per_chunk / (arrival[-1] - arrival[0])
+
+    def get_backlog(self):
+        """Samples waiting in the LSL inlet, None when there is no inlet queue to inspect."""
+        if self.mode != 'online' or not self.running:
+            return None
+        return self.inlet.samples_available()
+
+    def select_leads(self, samples):
+        """Picks the configured leads from a (n_samples, n_channels) chunk, subtracting the reference channels.
+        A 1-D chunk is a single channel."""
+        if samples.ndim == 1:
+            samples = samples.reshape(-1, 1)
+        leads = samples[:, self.lead_pos]
+        if self.derived_leads.size:
+            leads[:, self.derived_leads] -= samples[:, self.lead_neg]
+        return leads
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def get_data(self, lead=None):
+        """Filtered samples and their timestamps. In multi-channel mode `lead` selects one column,
+        otherwise all leads are returned as a (n_samples, n_leads) array."""
+        if self.leads is None:
+            lead = None
+
+        # Readers asking for the same version of the buffers get the same read-only arrays
+        view = self.views.get(lead)
+        if view is not None and view[0] == self.sequence:
+            return view[1], view[2]
+        view = self.read_snapshot(lambda: (self.sequence, self.data_buffer.snapshot(channel=lead), self.time_buffer.snapshot()))
+        view[1].flags.writeable = False
+        view[2].flags.writeable = False
+        self.views[lead] = view
+        return view[1], view[2]
     
+    def get_data_since(self, sample_index, lead=None):
+        """Samples added since the first `sample_index` samples (at most a full buffer), their timestamps
+        and the current sample count, which is the `sample_index` to pass in the next call."""
+        if self.leads is None:
+            lead = None
+
+        def read():
+            sample_count = self.sample_count
+            new_samples = sample_count - sample_index
+            if new_samples < 0:
+                new_samples = sample_count
+            return (self.data_buffer.snapshot(new_samples, channel=lead),
+                    self.time_buffer.snapshot(new_samples),
+                    sample_count)
+        return self.read_snapshot(read)
+
     def filter_data(self, new_data):
-        filtered_data, self.zi_h = signal.lfilter(self.b_h, self.a_h, new_data, zi=self.zi_h)
-        filtered_data, self.zi_l = signal.lfilter(self.b_l, self.a_l, filtered_data, zi=self.zi_l)
-        filtered_data, self.zi_n = signal.lfilter(self.b_n, self.a_n, filtered_data, zi=self.zi_n)
-        return filtered_data
+        sos, zi = self.filter_state
+        return sosfilt_chunk(sos, new_data, zi)
     
+    def restart(self, pre_roll):
+        """Clears the buffers before a discontinuity in the signal and brings the filters to the state
+        they would have at the end of `pre_roll`, the samples preceding the new position."""
+        self.reset_buffers()
+        with self.data_lock:
+            sos, _ = self.filter_state
+            zi = sosfilt_state(sos, self.n_leads)
+            if len(pre_roll):
+                zi *= np.reshape(pre_roll[0], (-1, 1, 1))
+            self.filter_state = (sos, zi)
+            if len(pre_roll):
+                self.filter_data(pre_roll)
+
     def reset_buffers(self):
         with self.data_lock:
+            self.sequence += 1
             self.data_buffer.clear()
             self.time_buffer.clear()
-            self.current_time = 0
+            self.chunk_end_time.clear()
+            self.chunk_arrival.clear()
+            self.sample_count = 0
+            self.session += 1
+            self.sequence += 1
 
     def start(self):
         if not self.running:
             self.reset_buffers()
+            if self.mode == 'online':
+                self.pull_buffer = np.zeros((self.samps_per_chunk, self.inlet.channel_count), dtype=np.dtype(self.inlet.value_type))
+                self.time_correction = 0.0
+                self.time_correction_updated = -np.inf
             self.running = True
             self.data_thread = threading.Thread(target=self.add_data_continuously)
             self.data_thread.start()
@@ -122,8 +387,29 @@ class SignalProcessor:
         self.data_thread.join()
 
 class PeaksDetector:
-    def __init__(self, signal_processor, find_peaks_setting=None):
+    """Detects R-peaks in the filtered signal. In 'batch' mode the signal buffer is searched with
+    scipy.signal.find_peaks once per second; in 'streaming' mode every new chunk from the
+    SignalProcessor is fed to a Pan-Tompkins detector as soon as it is filtered.
+    With a multi-channel SignalProcessor the peaks are searched in lead number `lead`; with lead='auto' the
+    lead with the most prominent R-peaks is selected again every `lead_interval` seconds.
+
+    With pipeline='event' the threads sleep until their upstream publishes new data instead of
+    polling every second: the batch detector runs on new chunks, at most once per refractory period
+    (`refractory` seconds, as it searches the whole buffer every time), and BPM is recalculated
+    only when new RR intervals arrive. Time-domain HRV (get_hrv_metrics) is kept over sliding windows
+    of `hrv_windows` seconds, and BPM, RMSSD and coherence of the whole session in `history`."""
+
+    def __init__(self, signal_processor, find_peaks_setting=None, detector='batch', lead=0, pipeline='polling', hrv_windows=(30, 60, 300),
+                 lead_interval=10, refractory=0.2):
         self.signal_processor = signal_processor
+        self.detector = detector
+        self.pipeline = pipeline
+        self.streaming_detector = None
+        self.auto_lead = lead == 'auto'
+        self.lead = 0 if self.auto_lead else lead
+        self.lead_interval = lead_interval
+        self.refractory = refractory # seconds between two R-peaks, also after the last detected one
+        self.lead_selected = None # monotonic time of the last automatic lead selection
         if find_peaks_setting is None:
             self.find_peaks_setting = {
                 'prominence': 1000,
@@ -135,11 +421,23 @@ class PeaksDetector:
             self.find_peaks_setting = find_peaks_setting
 
         self.last_peak_index = -1 # index of the last peak in the data_buffer in seconds
+        self.session = signal_processor.session # buffers session the peaks belong to
         self.peak_buffor_size = 160
         self.rr_intervals = deque(maxlen=self.peak_buffor_size-1) 
         self.peaks_time = deque(maxlen=self.peak_buffor_size)
         self.peaks_prominence = deque(maxlen=self.peak_buffor_size)
         self.bpm_list = deque(maxlen=self.peak_buffor_size)
+        self.bpm_count = 0 # number of BPM values calculated since the last reset
+        self.time_domain = RollingHRV(hrv_windows) # SDNN, RMSSD, pNN50 and mean HR, updated with every RR interval
+        self.history = SessionHistory()
+
+        # Seconds from the arrival of an R-peak to its detection, and of the last detected R-peak
+        self.peak_latency = deque(maxlen=100)
+        self.last_peak_arrival = None
+        self.peaks_updated = UpdateNotifier()
+
+        # Callbacks receiving every batch of new peaks as (peaks, prominences, rr_intervals)
+        self.peak_listeners = []
 
         # Synchronization and threading
         self.peaks_lock = threading.Lock()
@@ -147,37 +445,71 @@ class PeaksDetector:
         self.running = False
 
     def update_peaks_thread(self):
+        data_version = self.signal_processor.data_updated.version
         while self.running:
-            self.update_peaks()
-            time.sleep(1)
+            started = time.perf_counter()
+            with metrics.STAGE_SECONDS.labels('peaks').time():
+                self.update_peaks()
+            if self.pipeline == 'event':
+                # find_peaks scans the whole buffer, so it is not rerun for every 16-sample chunk; waiting
+                # one refractory period delays a detection by at most that much
+                time.sleep(max(0.0, self.refractory - (time.perf_counter() - started)))
+            data_version = next_iteration(self.pipeline, self.signal_processor.data_updated, data_version, 'peaks')
+
+    def check_session(self):
+        # After a reset of the signal buffers (e.g. a seek in a replay) the old peaks no longer apply
+        if self.signal_processor.session != self.session:
+            self.reset_peaks()
+            if self.streaming_detector is not None:
+                self.streaming_detector.reset()
 
     def update_peaks(self):
-        with self.signal_processor.data_lock:
-            data = np.array(self.signal_processor.data_buffer)
-            time_buffer = np.array(self.signal_processor.time_buffer)
+        self.check_session()
+        self.update_lead()
+        data, time_buffer = self.signal_processor.get_data(self.lead)
 
         if data.size == 0:
             return
         
         if self.last_peak_index >= 0:
-            valid_mask = time_buffer > self.last_peak_index + 0.2
+            valid_mask = time_buffer > self.last_peak_index + self.refractory
             data = data[valid_mask]
             time_buffer = time_buffer[valid_mask]
 
         if data.size == 0:
             return
         
-        peaks, properties = signal.find_peaks(data, 
-                                       prominence=self.find_peaks_setting['prominence'], 
-                                       width=self.find_peaks_setting['width'],
-                                       height=self.find_peaks_setting['height'])
+        peaks, prominences = self.detect_peaks(data)
         
         if peaks.size == 0:
             return 
         
-        peaks = time_buffer[peaks]
+        self.add_peaks(time_buffer[peaks], prominences)
 
+    def detect_peaks(self, data, distance=None):
+        """Indices and prominences of the R-peaks found in `data` with the current find_peaks settings."""
+        peaks, properties = signal.find_peaks(data, 
+                                       prominence=self.find_peaks_setting['prominence'], 
+                                       width=self.find_peaks_setting['width'],
+                                       height=self.find_peaks_setting['height'],
+                                       distance=distance)
+        return peaks, properties['prominences']
+
+    def process_samples(self, new_data, filtered_data, time_data):
+        start = time.perf_counter()
+        self.check_session()
+        self.update_lead()
+        if filtered_data.ndim == 2:
+            filtered_data = filtered_data[:, self.lead]
+        peaks, prominences = self.streaming_detector.process(filtered_data, time_data)
+        if peaks.size:
+            self.add_peaks(peaks, prominences)
+        metrics.STAGE_SECONDS.labels('peaks').observe(time.perf_counter() - start)
+
+    def add_peaks(self, peaks, prominences):
+        start = time.perf_counter()
         with self.peaks_lock:
+            metrics.LOCK_WAIT_SECONDS.labels('peaks').observe(time.perf_counter() - start)
             if self.peaks_time:
                 new_peaks = np.concatenate(([self.peaks_time[-1]], peaks))
             else:
@@ -187,21 +519,79 @@ class PeaksDetector:
             
             if new_rr_intervals.size > 0:
                 self.rr_intervals.extend(new_rr_intervals)
+                # Instantaneous BPM and the RMSSD of the shortest window after every beat
+                for peak, rr in zip(new_peaks[1:], new_rr_intervals):
+                    self.time_domain.extend([peak], [rr])
+                    self.history.add(peak, bpm=60.0 / rr, rmssd=self.time_domain.windows[0].values()['rmssd'])
 
             self.peaks_time.extend(peaks)
-            self.peaks_prominence.extend(properties['prominences'])
+            self.peaks_prominence.extend(prominences)
             self.last_peak_index = peaks[-1]
 
+            self.last_peak_arrival = self.signal_processor.arrival_time(peaks[-1])
+            self.peak_latency.append(time.perf_counter() - self.last_peak_arrival)
+        self.peaks_updated.notify()
+        metrics.PEAKS.inc(len(peaks))
+
+        for listener in self.peak_listeners:
+            listener(peaks, prominences, new_rr_intervals)
+
+    def add_peak_listener(self, listener):
+        self.peak_listeners.append(listener)
+
+    def remove_peak_listener(self, listener):
+        if listener in self.peak_listeners:
+            self.peak_listeners.remove(listener)
+
+    def set_lead(self, lead):
+        if lead == self.lead:
+            return
+        self.lead = lead
+        # The streaming detector thresholds are learned per lead
+        if self.streaming_detector is not None:
+            self.streaming_detector.reset()
+
+    def update_lead(self):
+        # With lead='auto' the lead is selected once the buffer holds a few seconds of signal, then every lead_interval
+        if not self.auto_lead or self.signal_processor.leads is None:
+            return
+        now = time.monotonic()
+        if self.lead_selected is not None and now - self.lead_selected < self.lead_interval:
+            return
+        data, _ = self.signal_processor.get_data()
+        if data.shape[0] < 2 * self.signal_processor.sampling_rate:
+            return
+        self.lead_selected = now
+        self.select_best_lead(data)
+
+    def select_best_lead(self, data=None):
+        """Switches to the lead with the most prominent R-peaks relative to its noise level."""
+        if self.signal_processor.leads is None:
+            return self.lead
+        if data is None:
+            data, _ = self.signal_processor.get_data()
+        if data.shape[0] == 0:
+            return self.lead
+        amplitude = np.percentile(np.abs(data), 99, axis=0)
+        noise = np.median(np.abs(data - np.median(data, axis=0)), axis=0) + 1e-12
+        self.set_lead(int(np.argmax(amplitude / noise)))
+        return self.lead
+
     def get_peaks(self):   
         with self.peaks_lock: 
             return np.array(self.peaks_time), np.array(self.peaks_prominence)
     
     def calculate_bpm_thread(self):
+        peaks_version = self.peaks_updated.version
         while self.running:
-            with self.peaks_lock:
-                new_rr_intervals = list(self.rr_intervals)[-5:]
-            self.calculate_bpm(new_rr_intervals)
-            time.sleep(1)
+            seen_version = peaks_version
+            peaks_version = next_iteration(self.pipeline, self.peaks_updated, peaks_version, 'bpm')
+            if self.pipeline == 'event' and peaks_version == seen_version:
+                continue
+            with metrics.STAGE_SECONDS.labels('bpm').time():
+                with self.peaks_lock:
+                    new_rr_intervals = list(self.rr_intervals)[-5:]
+                self.calculate_bpm(new_rr_intervals)
 
     def calculate_bpm(self, new_rr_intervals):
         if not len(new_rr_intervals):
@@ -209,89 +599,244 @@ class PeaksDetector:
         bpm = 60.0 / np.array(new_rr_intervals)
         with self.bpm_lock:
             self.bpm_list.extend([np.mean(bpm)])
+            self.bpm_count += 1
 
     def get_bpm(self):
         with self.bpm_lock:
             return np.array(self.bpm_list)
+
+    def get_hrv_metrics(self):
+        """Time-domain HRV by window length in seconds: beats, SDNN and RMSSD in ms, pNN50 in %, mean HR in BPM."""
+        with self.peaks_lock:
+            return self.time_domain.values()
+
+    def get_bpm_since(self, bpm_index):
+        """BPM values calculated after the first `bpm_index` ones (at most the whole buffer)
+        and the current BPM count, which is the `bpm_index` to pass in the next call."""
+        with self.bpm_lock:
+            new_values = self.bpm_count - bpm_index
+            if new_values < 0:
+                new_values = self.bpm_count
+            new_values = min(new_values, len(self.bpm_list))
+            return np.array(self.bpm_list)[len(self.bpm_list) - new_values:], self.bpm_count
     
     def reset_peaks(self):
         with self.peaks_lock:
             self.peaks_time.clear()
             self.peaks_prominence.clear()
             self.rr_intervals.clear()
+            self.time_domain.clear()
+            self.history.clear()
             self.bpm_list.clear()
+            self.bpm_count = 0
+            self.peak_latency.clear()
             self.last_peak_index = -1
+            self.last_peak_arrival = None
+            self.lead_selected = None
+            self.session = self.signal_processor.session
 
     def start(self):
         if not self.running:
             self.reset_peaks()
             self.running = True
-            self.peaks_thread = threading.Thread(target=self.update_peaks_thread)
+            if self.detector == 'streaming':
+                self.streaming_detector = PanTompkinsDetector(self.signal_processor.sampling_rate)
+                self.signal_processor.add_listener(self.process_samples)
+            else:
+                self.peaks_thread = threading.Thread(target=self.update_peaks_thread)
+                self.peaks_thread.start()
             self.bpm_thread = threading.Thread(target=self.calculate_bpm_thread)
-            self.peaks_thread.start()
             self.bpm_thread.start()
 
     def stop(self):
         self.running = False
-        self.peaks_thread.join()
+        if self.detector == 'streaming':
+            self.signal_processor.remove_listener(self.process_samples)
+        else:
+            self.peaks_thread.join()
         self.bpm_thread.join()
 
 
 class HRVAnalyzer:
-    def __init__(self, peaks_detector):
+    """HRV spectrum and coherence of the RR intervals found by a PeaksDetector. The spectrum covers the last
+    `window_seconds` of RR intervals and is recalculated only when new RR intervals arrive. With
+    estimator='fft' it is the periodogram of the RR tachogram resampled at 1 Hz, zero-padded to `fft_length`
+    points; with estimator='lomb' the Lomb-Scargle periodogram of the RR intervals at the beat times, on the
+    same frequency grid limited to 0.0033-0.4 Hz. Coherence is recalculated only for a new spectrum and kept
+    as a series of the newest `trend_length` values (get_coherence_trend) and session totals
+    (get_coherence_summary)."""
+
+    def __init__(self, peaks_detector, pipeline='polling', window_seconds=128, fft_length=1024, estimator='fft',
+                 trend_length=3600):
         self.peaks_detector = peaks_detector
+        self.pipeline = pipeline
+        self.estimator = estimator
+        self.window_seconds = window_seconds
+        self.tachogram_fs = 1
+        self.window_length = int(window_seconds * self.tachogram_fs)
+        if fft_length < self.window_length:
+            raise ValueError(f"fft_length ({fft_length}) shorter than the {self.window_length} samples of the window")
+        self.fft_length = fft_length
+        self.frequency_grid = np.fft.rfftfreq(fft_length, 1 / self.tachogram_fs)
+        self.frequency_grid.flags.writeable = False
+        self.lomb_frequencies = self.frequency_grid[(self.frequency_grid > 0.0033) & (self.frequency_grid < 0.4)]
+        self.lomb_beat = None # (session, time) of the newest beat in the last Lomb-Scargle spectrum
+        self.window_cache = {} # tachogram length -> (Hann window, cubic trend basis, its pseudoinverse)
+        self.band_cache = {} # frequency grid (size, first, last) -> coherence bands and their Simpson weights
+
+        # The tachogram is resampled on a fixed grid (sample i at i / tachogram_fs seconds), so only the
+        # samples after the previous newest RR interval have to be interpolated when new beats arrive
+        self.tachogram = RingBuffer(self.window_length)
+        self.tachogram_next = None # grid index of the next tachogram sample
+        self.tachogram_session = None
         self.frequencies = None
         self.power = None
         self.coherence = None
+        self.coherence_value = None
         self.x_coherence = np.linspace(-4, 4, 1000)
+        self.coherence_shape = np.exp(-(self.x_coherence**2) / 2) # display curve, scaled by the coherence value
+        self.coherence_shape /= np.max(self.coherence_shape)
+        self.spectrum_version = 0 # incremented with every new spectrum
+        self.coherence_version = None # of the spectrum of the last coherence value
+        self.coherence_trend = RingBuffer(trend_length, channels=2) # time of the newest beat, coherence
+        self.trend_session = None # peaks session of the trend and the totals
+        self.coherence_sum = 0.0
+        self.coherence_count = 0
+        self.coherence_max = None
+
+        # Seconds from the arrival of the newest R-peak to the spectrum and coherence that include it
+        self.hrv_latency = deque(maxlen=100)
+        self.coherence_latency = deque(maxlen=100)
+        self.spectrum_arrival = None
+        self.coherence_arrival = None
+        self.spectrum_time = None # time of the newest beat in the spectrum
+        self.spectrum_session = None
+        self.hrv_updated = UpdateNotifier()
+        self.coherence_updated = UpdateNotifier()
 
         # Synchronization and threading
         self.hrv_lock = threading.Lock()
         self.coh_lock = threading.Lock()
         self.running = False
 
-    def periodogram(self, s, okno , Fs):
-        okno = okno / np.linalg.norm(okno)
-        s = s * okno
-        N_fft = len(s)
-        S = np.fft.rfft(s, N_fft)
-        P = S * S.conj()
-        P = P.real / Fs
-        F = np.fft.rfftfreq(N_fft, 1 / Fs)
-        if len(s) % 2 == 0:
+    def periodogram(self, s):
+        """One-sided periodogram of the tachogram `s` after removing its cubic trend, with a Hann window
+        spanning the samples, zero-padded to fft_length. Windows and trend bases are cached per length."""
+        n = len(s)
+        if n not in self.window_cache:
+            okno = signal.windows.hann(n)
+            trend = np.vander(np.linspace(-1, 1, n), 4)
+            self.window_cache[n] = (okno / np.linalg.norm(okno), trend, np.linalg.pinv(trend))
+        okno, trend, trend_pinv = self.window_cache[n]
+
+        s = (s - trend @ (trend_pinv @ s)) * okno
+        S = np.fft.rfft(s, self.fft_length)
+        P = S.real ** 2 + S.imag ** 2
+        P /= self.tachogram_fs
+        if self.fft_length % 2 == 0:
             P[1:-1] *= 2
         else:
             P[1:] *= 2
-        return (F, P)
+        return (self.frequency_grid, P)
+
+    def lomb_periodogram(self, t, s):
+        """Lomb-Scargle periodogram of the samples `s` at the uneven times `t` after removing their cubic
+        trend, over lomb_frequencies, scaled like the one-sided periodogram of evenly sampled data. The
+        grid is uniform, so exp(iwt) of all the frequencies is a running product of exp(i dw t) instead of
+        a sine and cosine of every frequency and sample."""
+        n = len(t)
+        trend = np.vander((2 * t - t[0] - t[-1]) / (t[-1] - t[0]), 4)
+        s = s - trend @ np.linalg.lstsq(trend, s, rcond=None)[0]
+
+        F = self.lomb_frequencies
+        t = t - t[-1]
+        E = np.empty((len(F), n), dtype=complex)
+        E[0] = np.exp(2j * np.pi * F[0] * t)
+        E[1:] = np.exp(2j * np.pi * (F[1] - F[0]) * t)
+        E = np.cumprod(E, axis=0)
+        Z = E @ s # sums of s*cos(wt) + i*s*sin(wt)
+        W = (E * E).sum(axis=1) # sums of cos(2wt) + i*sin(2wt)
+
+        # The time offset tau of every frequency, tan(2w*tau) = sum(sin(2wt)) / sum(cos(2wt)), applied to the sums
+        c, sn = np.cos(np.angle(W) / 2), np.sin(np.angle(W) / 2)
+        cc, ss, cs = (n + W.real) / 2, (n - W.real) / 2, W.imag / 2
+        P = ((c * Z.real + sn * Z.imag) ** 2 / (c * c * cc + 2 * c * sn * cs + sn * sn * ss)
+             + (c * Z.imag - sn * Z.real) ** 2 / (c * c * ss - 2 * c * sn * cs + sn * sn * cc)) / 2
+        return (F, P * 2 * (t[-1] - t[0]) / (n - 1))
     
     def calculate_hrv_thread(self):
+        peaks_version = self.peaks_detector.peaks_updated.version
         while self.running:
-            self.calculate_hrv()
-            time.sleep(1)
+            with metrics.STAGE_SECONDS.labels('hrv').time():
+                self.calculate_hrv()
+            peaks_version = next_iteration(self.pipeline, self.peaks_detector.peaks_updated, peaks_version, 'hrv')
 
     def calculate_hrv(self):
         with self.peaks_detector.peaks_lock:
             if len(self.peaks_detector.rr_intervals) < 10:
                 return
             peaks = np.array(self.peaks_detector.peaks_time)
-            RR = np.array(self.peaks_detector.rr_intervals) * self.peaks_detector.signal_processor.sampling_rate
-            RR_new = interpolate.interp1d(peaks[:-1], 1/RR, kind='linear')
-
-        Fs_2 = 1
-        t2 = np.arange(peaks[0], peaks[-2], 1/Fs_2)
-        p = np.polyfit(t2, RR_new(t2), deg=3)
-        f = np.polyval(p, t2)
-        sig = RR_new(t2) - f
-        k = 20
-        okno = signal.windows.hann(k *len(t2))
-
-        zero_padding_lenght = k * len(sig)
-        sig_padded = np.pad(sig, (0, zero_padding_lenght - len(sig)), 'constant')
-        F, P = self.periodogram(sig_padded, okno, Fs_2)   
+            rr_intervals = np.array(self.peaks_detector.rr_intervals)
+            peak_arrival = self.peaks_detector.last_peak_arrival
+            session = self.peaks_detector.session
+
+        knots = peaks[:len(rr_intervals)]
+        if self.estimator == 'lomb':
+            if (session, knots[-1]) == self.lomb_beat:
+                return # no new RR intervals, the spectrum would be the same
+            self.lomb_beat = (session, knots[-1])
+            F, P = self.hrv_spectrum(peaks, rr_intervals)
+        else:
+            # The tachogram starts over for new buffers or peaks that do not continue it
+            first, end = self.tachogram_grid(knots)
+            if session != self.tachogram_session or self.tachogram_next is None or not first <= self.tachogram_next <= end:
+                self.tachogram.clear()
+                self.tachogram_next = first
+                self.tachogram_session = session
+            if end == self.tachogram_next:
+                return # no new RR intervals, the spectrum would be the same
+
+            self.tachogram.extend(self.resample_rr(knots, rr_intervals, self.tachogram_next, end))
+            self.tachogram_next = end
+            if len(self.tachogram) < 4:
+                return
+            F, P = self.periodogram(self.tachogram.snapshot())
         
+        start = time.perf_counter()
         with self.hrv_lock:
+            metrics.LOCK_WAIT_SECONDS.labels('hrv').observe(time.perf_counter() - start)
             self.frequencies = F
             self.power = P  
+            self.spectrum_time = peaks[-1]
+            self.spectrum_session = session
+            self.spectrum_version += 1
+            if peak_arrival != self.spectrum_arrival:
+                self.hrv_latency.append(time.perf_counter() - peak_arrival)
+            self.spectrum_arrival = peak_arrival
+        self.hrv_updated.notify()
+
+    def tachogram_grid(self, knots):
+        """Grid indices of the first and one past the last tachogram sample between the `knots` (beat times)."""
+        return int(np.ceil(knots[0] * self.tachogram_fs)), int(np.ceil(knots[-1] * self.tachogram_fs))
+
+    def resample_rr(self, knots, rr_intervals, first, end):
+        """1/RR (RR in samples of the signal) of the beats at `knots`, linearly interpolated at the grid
+        samples from `first` to `end`."""
+        RR = rr_intervals * self.peaks_detector.signal_processor.sampling_rate
+        return np.interp(np.arange(first, end) / self.tachogram_fs, knots, 1 / RR)
+
+    def hrv_spectrum(self, peaks, rr_intervals):
+        """Spectrum of the last window_seconds of `rr_intervals` between consecutive `peaks`: the periodogram
+        of the detrended RR tachogram resampled at 1 Hz or the Lomb-Scargle periodogram at the beat times."""
+        knots = peaks[:len(rr_intervals)]
+        if self.estimator == 'lomb':
+            window = knots >= knots[-1] - self.window_seconds
+            RR = rr_intervals[window] * self.peaks_detector.signal_processor.sampling_rate
+            return self.lomb_periodogram(knots[window], 1 / RR)
+
+        first, end = self.tachogram_grid(knots)
+        first = max(first, end - self.window_length)
+        return self.periodogram(self.resample_rr(knots, rr_intervals, first, end))
 
     def get_frequencies(self):
         with self.hrv_lock: 
@@ -302,45 +847,125 @@ class HRVAnalyzer:
             return np.array(self.power)
     
     def calculate_coherence_thread(self):
+        hrv_version = self.hrv_updated.version
         while self.running:
-            self.calculate_coherence()
-            time.sleep(1)
+            with metrics.STAGE_SECONDS.labels('coherence').time():
+                self.calculate_coherence()
+            hrv_version = next_iteration(self.pipeline, self.hrv_updated, hrv_version, 'coherence')
 
     def calculate_coherence(self):
         with self.hrv_lock:
-            if self.frequencies is None:
-                return
-            F = np.array(self.frequencies)
-            P = np.array(self.power)
-
-        mask1 = (F > 0.04) & (F < 0.26)
-        F1 = F[mask1]
-        P1 = P[mask1]
-        highest_peak_index = np.argmax(P1)
-        highest_peak_frame = [F1[highest_peak_index] - 0.015, F1[highest_peak_index] + 0.015]
-        highest_peak_arr = (F1 > highest_peak_frame[0]) & (F1 < highest_peak_frame[1])
-        peak_power = integrate.simpson(P1[highest_peak_arr], x=F1[highest_peak_arr])
-
-        mask2 = (F > 0.0033) & (F < 0.4)
-        F2 = F[mask2]
-        P2 = P[mask2]
-        total_power = integrate.simpson(P2, x=F2)           
-        coherence_value  = peak_power/total_power
+            if self.frequencies is None or self.spectrum_version == self.coherence_version:
+                return # the same spectrum, the same coherence
+            # The spectrum arrays are replaced by calculate_hrv, never modified in place
+            F = self.frequencies
+            P = self.power
+            version = self.spectrum_version
+            peak_arrival = self.spectrum_arrival
+            spectrum_time = self.spectrum_time
+            session = self.spectrum_session
+
+        coherence_value = self.coherence_ratio(F, P)
+        self.coherence_version = version
+        self.peaks_detector.history.add(spectrum_time, coherence=coherence_value)
 
         with self.coh_lock:
-            self.coherence = ((1 / (np.sqrt(2 * np.pi))) * np.exp(-(self.x_coherence**2) / 2))
-            self.coherence /= np.max(self.coherence)
-            self.coherence *= coherence_value
+            if session != self.trend_session:
+                self.clear_trend()
+                self.trend_session = session
+            self.coherence = self.coherence_shape * coherence_value
+            self.coherence_value = coherence_value
+            self.coherence_trend.extend([[spectrum_time, coherence_value]])
+            self.coherence_sum += coherence_value
+            self.coherence_count += 1
+            self.coherence_max = coherence_value if self.coherence_max is None else max(self.coherence_max, coherence_value)
+            if peak_arrival != self.coherence_arrival:
+                self.coherence_latency.append(time.perf_counter() - peak_arrival)
+            self.coherence_arrival = peak_arrival
+        self.coherence_updated.notify()
+
+    def coherence_bands(self, F):
+        """Index ranges of 0.04-0.26 Hz and 0.0033-0.4 Hz in the ascending frequency grid `F`, the Simpson's rule
+        weights of the 0.0033-0.4 Hz range and a cache for the weights of the peak ranges, per grid."""
+        key = (len(F), F[0], F[-1])
+        if key not in self.band_cache:
+            total_band = slice(np.searchsorted(F, 0.0033, 'right'), np.searchsorted(F, 0.4, 'left'))
+            self.band_cache[key] = (slice(np.searchsorted(F, 0.04, 'right'), np.searchsorted(F, 0.26, 'left')),
+                                    total_band, simpson_weights(F[total_band]), {})
+        return self.band_cache[key]
+
+    def coherence_ratio(self, F, P):
+        """Power around the highest peak in 0.04-0.26 Hz relative to the total power in 0.0033-0.4 Hz."""
+        band, total_band, total_weights, peak_weights = self.coherence_bands(F)
+        F1 = F[band]
+        P1 = P[band]
+        highest_peak = F1[np.argmax(P1)]
+        peak_frame = (np.searchsorted(F1, highest_peak - 0.015, 'right'), np.searchsorted(F1, highest_peak + 0.015, 'left'))
+        if peak_frame not in peak_weights:
+            peak_weights[peak_frame] = simpson_weights(F1[peak_frame[0]:peak_frame[1]])
+        peak_power = peak_weights[peak_frame] @ P1[peak_frame[0]:peak_frame[1]]
+
+        total_power = total_weights @ P[total_band]
+        return peak_power/total_power
 
     def get_coherence(self):
         with self.coh_lock:
             return (np.array(self.x_coherence), np.array(self.coherence))
 
+    def get_coherence_value(self):
+        with self.coh_lock:
+            return self.coherence_value
+
+    def get_coherence_trend(self):
+        """Times of the newest beat and coherence values of the last trend_length spectra."""
+        with self.coh_lock:
+            trend = self.coherence_trend.snapshot()
+        return (trend[:, 0], trend[:, 1])
+
+    def get_coherence_summary(self):
+        """Number, mean and maximum of the coherence values since the start of the session."""
+        with self.coh_lock:
+            return {'count': self.coherence_count,
+                    'mean': self.coherence_sum / self.coherence_count if self.coherence_count else None,
+                    'max': self.coherence_max}
+
+    def get_latency(self):
+        """Mean and maximum latency in ms of each stage, measured from the arrival of the R-peak."""
+        latency = {}
+        for stage, values in (('peaks', self.peaks_detector.peak_latency),
+                              ('hrv', self.hrv_latency),
+                              ('coherence', self.coherence_latency)):
+            values = np.array(values) * 1000
+            latency[stage] = {'mean': np.mean(values) if values.size else None,
+                              'max': np.max(values) if values.size else None}
+        return latency
+
     def reset_hrv(self):
         with self.hrv_lock:
             self.frequencies = None
             self.power = None
             self.coherence = None
+            self.coherence_value = None
+            self.spectrum_arrival = None
+            self.coherence_arrival = None
+            self.spectrum_time = None
+            self.spectrum_session = None
+            self.coherence_version = None
+            self.tachogram.clear()
+            self.tachogram_next = None
+            self.tachogram_session = None
+            self.lomb_beat = None
+            self.hrv_latency.clear()
+            self.coherence_latency.clear()
+            with self.coh_lock:
+                self.clear_trend()
+                self.trend_session = None
+
+    def clear_trend(self):
+        self.coherence_trend.clear()
+        self.coherence_sum = 0.0
+        self.coherence_count = 0
+        self.coherence_max = None
 
     def start(self):
         if not self.running:
@@ -3,38 +3,357 @@ from dash import dcc, html
 from dash.dependencies import Input, Output, State
 import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
-from breath import creating_ramp
+import flask
+from breath import creating_pacer, PACER_STEP_JS
+from render_cache import RenderCache
+import metrics
 import numpy as np
+import base64
+import time
 
 chart_settings = {
     'ekg': {
         'range': [-500, 2000],
+        'points': 1000, # samples sent to the browser, 0 for all of them
     },
     'hr': {
         'range': [50, 150],
     }
 }
 
+# Figure builders used by the chart callbacks
+def peak_segments(peaks, y0=0, y1=2000):
+    """Vertical marker lines for the peaks, as NaN-separated segments of a single trace."""
+    x = np.repeat(np.asarray(peaks, dtype=float), 3)
+    x[2::3] = np.nan
+    y = np.tile([y0, y1, np.nan], len(peaks))
+    return x, y
+
+def typed_array(values, dtype='f4'):
+    """Array sent as a plotly.js typed array (base64 encoded little-endian binary) instead of JSON numbers.
+    Not usable for traces extended with extendData, which plotly.js extends with plain arrays only."""
+    values = np.ascontiguousarray(values, dtype='<' + dtype)
+    return {'dtype': dtype, 'bdata': base64.b64encode(values.data).decode('ascii')}
+
+def minmax_downsample(x, y, points):
+    """At most `points` samples: the minimum and maximum of each of points/2 equal buckets, in time order,
+    so that the R-peaks and the signal envelope are kept at any sampling rate."""
+    n = len(y)
+    if not points or n <= points:
+        return x, y
+    size = -(-n // (points // 2))
+    full = n - n % size
+    buckets = np.asarray(y[:full]).reshape(-1, size)
+    low, high = buckets.argmin(axis=1), buckets.argmax(axis=1)
+    index = np.column_stack((np.minimum(low, high), np.maximum(low, high))) + np.arange(0, full, size)[:, None]
+    index = index.ravel()
+    if full < n:
+        tail = np.asarray(y[full:])
+        index = np.concatenate((index, full + np.unique([tail.argmin(), tail.argmax()])))
+    return x[index], y[index]
+
+def ekg_figure(data_buffer, time_buffer, peaks=None, points=None):
+    # Signal as binary float32 (timestamps in float64), downsampled to `points` samples
+    x, y = minmax_downsample(time_buffer, data_buffer, points)
+    ekg_trace = go.Scatter(
+        x=typed_array(x, 'f8'),
+        y=typed_array(y),
+        mode='lines',
+        name=f'EKG Signal',
+    )
+    traces = [ekg_trace]
+
+    # All peak markers in one trace, limited to the visible time range
+    if peaks is not None:
+        if len(time_buffer):
+            peaks = peaks[(peaks >= time_buffer[0]) & (peaks <= time_buffer[-1])]
+        peaks_x, peaks_y = peak_segments(peaks)
+        traces.append(go.Scatter(
+            x=peaks_x,
+            y=peaks_y,
+            mode='lines',
+            name='Peaks',
+            line=dict(color="red", width=3)
+        ))
+
+    return {
+        'data': traces,
+        'layout': go.Layout(
+            title=f'Live EKG Data',
+            showlegend=False,
+            plot_bgcolor='white', 
+            paper_bgcolor='white',  
+            xaxis=dict(
+                gridcolor='white',  
+                linecolor='white',  
+                range=[time_buffer[0], time_buffer[-1]] if len(time_buffer) else None
+            ),
+            yaxis=dict(
+                gridcolor='lightgrey', 
+                linecolor='black',
+                range=[chart_settings['ekg']['range'][0], chart_settings['ekg']['range'][1]]
+            )
+        )
+    }
+
+def hr_figure(bpm, x=None, binary=True):
+    # The incremental mode extends this trace, so it needs plain arrays there
+    if binary:
+        bpm = typed_array(bpm)
+        x = None if x is None else typed_array(x, 'f8')
+    hr_trace = go.Scatter(
+        x=x,
+        y=bpm,
+        mode='lines',
+        name='Heart Rate'
+    )
+    return {
+        'data': [hr_trace],
+        'layout': go.Layout(
+            title='Live Heart Rate',
+            plot_bgcolor='white',  
+            paper_bgcolor='white',  
+            xaxis=dict(
+                gridcolor='lightgrey',  
+                linecolor='black'  
+            ),
+            yaxis=dict(
+                gridcolor='lightgrey',  
+                linecolor='black', 
+                range=[chart_settings['hr']['range'][0], chart_settings['hr']['range'][1]]
+            )
+        )
+    }
+
+def hrv_figure(F, P):
+    if np.array_equal(F, np.array(None)) or np.array_equal(P, np.array(None)):
+        F = np.zeros(100)
+        P = np.linspace(0,1,100)
+    
+    hrv_trace = go.Scatter(
+        x=typed_array(F),
+        y=typed_array(P),
+        mode='lines',
+        name='Heart Rate Variability'
+    )
+    
+    return {
+        'data': [hrv_trace],
+        'layout': go.Layout(
+            title='Live Heart Rate Variability',
+            plot_bgcolor='white',  
+            paper_bgcolor='white', 
+            xaxis=dict(
+                gridcolor='lightgrey', 
+                linecolor='black',
+                range = [0,0.55]  # Range of frequencies
+            ),
+            yaxis=dict(
+                gridcolor='lightgrey', 
+                linecolor='black', 
+                #range=[0,300] 
+            )
+        )
+    }
+
+def coherence_figure(x, coh):
+    if np.array_equal(coh, np.array(None)) :
+        coh = np.zeros(len(x))
+    
+    x = x[::10]
+    coh = coh[::10]
+
+    coherence_trace = go.Scatter(
+        x=typed_array(x),
+        y=typed_array(coh),
+        mode='lines',
+        name='Coherence'
+    )
+    
+    return {
+        'data': [coherence_trace],
+        'layout': go.Layout(
+            title='Coherence',
+            plot_bgcolor='white',
+            paper_bgcolor='white',  
+            xaxis=dict(
+                gridcolor='lightgrey',  
+                linecolor='lightgray',
+                range = [-4,4],  
+                showticklabels=False
+            ),
+            yaxis=dict(
+                gridcolor='lightgrey',  
+                linecolor='lightgray',  
+                range=[0,1]  
+            )
+        )
+    }
+
+# Heart rate of the whole session from the SessionHistory: mean BPM per row, with a min/max band when the rows
+# are aggregates
+def session_hr_figure(start_time, times, fields):
+    mean, low, high = fields['bpm']
+    rows = ~np.isnan(mean)
+    x = typed_array((times[rows] - start_time) / 60) if start_time is not None else []
+    traces = []
+    if low is not mean:
+        traces += [
+            go.Scatter(x=x, y=typed_array(high[rows]), mode='lines', line=dict(width=0), hoverinfo='skip', showlegend=False),
+            go.Scatter(x=x, y=typed_array(low[rows]), mode='lines', line=dict(width=0), fill='tonexty',
+                       fillcolor='rgba(31, 119, 180, 0.2)', name='Min/max'),
+        ]
+    traces.append(go.Scatter(x=x, y=typed_array(mean[rows]), mode='lines', line=dict(color='rgb(31, 119, 180)'), name='Heart Rate'))
+    return {
+        'data': traces,
+        'layout': go.Layout(
+            title='Session Heart Rate',
+            plot_bgcolor='white',
+            paper_bgcolor='white',
+            xaxis=dict(
+                title='min',
+                gridcolor='lightgrey',
+                linecolor='black'
+            ),
+            yaxis=dict(
+                gridcolor='lightgrey',
+                linecolor='black',
+                range=[chart_settings['hr']['range'][0], chart_settings['hr']['range'][1]]
+            )
+        )
+    }
+
+# Coherence of the last spectra, titled with the mean and maximum since the start of the session
+def coherence_trend_figure(start_time, times, values, summary):
+    if start_time is None and times.size:
+        start_time = times[0]
+    title = 'Coherence Trend'
+    if summary['count']:
+        title += f" - session mean {summary['mean']:.2f}, max {summary['max']:.2f}"
+    trend_trace = go.Scatter(
+        x=typed_array((times - start_time) / 60) if times.size else [],
+        y=typed_array(values),
+        mode='lines',
+        name='Coherence'
+    )
+    return {
+        'data': [trend_trace],
+        'layout': go.Layout(
+            title=title,
+            plot_bgcolor='white',
+            paper_bgcolor='white',
+            xaxis=dict(
+                title='min',
+                gridcolor='lightgrey',
+                linecolor='black'
+            ),
+            yaxis=dict(
+                gridcolor='lightgrey',
+                linecolor='black',
+                range=[0, 1]
+            )
+        )
+    }
+
+# Incremental mode: the EKG figure has a signal trace and a peak markers trace, both extended with extendData
+def ekg_stream_figure(data_buffer, time_buffer, peaks):
+    peaks_x, peaks_y = peak_segments(peaks)
+    return {
+        'data': [
+            {'type': 'scatter', 'x': time_buffer, 'y': data_buffer, 'mode': 'lines', 'name': 'EKG Signal'},
+            {'type': 'scatter', 'x': peaks_x, 'y': peaks_y, 'mode': 'lines', 'name': 'Peaks',
+             'line': {'color': 'red', 'width': 3}, 'showlegend': False},
+        ],
+        'layout': {
+            'title': {'text': 'Live EKG Data'},
+            'plot_bgcolor': 'white',
+            'paper_bgcolor': 'white',
+            'showlegend': False,
+            'xaxis': {'gridcolor': 'white', 'linecolor': 'white', 'autorange': True},
+            'yaxis': {'gridcolor': 'lightgrey', 'linecolor': 'black', 'range': list(chart_settings['ekg']['range'])},
+        }
+    }
+
+# Prometheus /metrics route and timing of every callback request, labelled with the callback output
+def add_metrics(app):
+    @app.server.before_request
+    def start_callback_timer():
+        flask.g.request_start = time.perf_counter()
+
+    @app.server.after_request
+    def observe_callback(response):
+        if flask.request.path.endswith('/_dash-update-component'):
+            body = flask.request.get_json(silent=True) or {}
+            output = body.get('output', 'unknown')
+            metrics.CALLBACK_SECONDS.labels(output).observe(time.perf_counter() - flask.g.request_start)
+            metrics.CALLBACK_BYTES.labels(output).inc(response.calculate_content_length() or 0)
+        return response
+
+    @app.server.route('/metrics')
+    def metrics_view():
+        return flask.Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 # Function to run the Dash app
-def run_dash_app_thread(signal_processor, peaks_detector, hrv_analyzer, interval, **breathing_settings):
-    app = run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval, **breathing_settings)
+def run_dash_app_thread(signal_processor, peaks_detector, hrv_analyzer, interval, incremental=False, **breathing_settings):
+    app = run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval, incremental, **breathing_settings)
     app.run(debug=True, port=8051, use_reloader=False)
 
 # Function to create the Dash app
-def run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval_value=1000, **breathing_settings):
+def run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval_value=1000, incremental=False, render_cache=True, render_max_age=0.25, **breathing_settings):
     app = dash.Dash(__name__)
+    add_metrics(app)
+
+    # Figures shared by all the clients: built once per new result, the EKG (new data with every chunk)
+    # at most once per render_max_age seconds
+    cache = RenderCache(render_max_age) if render_cache else None
+
+    def shared_figure(name, key, version, build):
+        if cache is None:
+            return build()
+        return cache.get(name, key, version, build)
+
+    breathing_figure, pacer, pacer_duration = creating_pacer(**breathing_settings, info_from_user = False)
+
+    # Seek, speed and event controls when a recorded session is replayed
+    replay = signal_processor.inlet if hasattr(signal_processor.inlet, 'seek') else None
+    replay_controls = html.Div()
+    if replay is not None:
+        replay_controls = html.Div([
+            dcc.Input(id='replay-time', type='number', min=0, placeholder='Time [s]'),
+            html.Button('Seek', id='replay-seek-button', n_clicks=0),
+            html.Button('Previous event', id='replay-previous-button', n_clicks=0),
+            html.Button('Next event', id='replay-next-button', n_clicks=0),
+            html.Label('Speed:'),
+            dcc.Input(id='replay-speed', type='number', min=0, value=replay.speed),
+            html.Span(id='replay-position'),
+        ])
     app.layout = html.Div([
         dcc.Tabs([
             dcc.Tab(label='Live Charts', children=[
                 html.Button('Start', id='start-button', n_clicks=0),
                 html.Button('Stop', id='stop-button', n_clicks=0),
                 dcc.Store(id='running-state', data=False),
+                dcc.Store(id='ekg-stream-state'),
+                dcc.Store(id='hr-stream-state'),
+                dcc.Store(id='hrv-stream-state'),
+                dcc.Store(id='coherence-stream-state'),
+                dcc.Store(id='session-stream-state'),
+                dcc.Store(id='trend-stream-state'),
+                html.Div(id='latency-info'),
+                html.Div(id='hrv-metrics'),
+                replay_controls,
                 html.Div([
                     dcc.Graph(id='live-graph-ekg', style={'width': '25%', 'display': 'inline-block'}),
                     dcc.Graph(id='live-graph-hr', style={'width': '25%', 'display': 'inline-block'}),
                     dcc.Graph(id='live-graph-hrv', style={'width': '25%', 'display': 'inline-block'}),
                     dcc.Graph(id='live-graph-coherence', style={'width': '25%', 'display': 'inline-block'}),
-                    dcc.Graph(id='breathing-scheme', figure=creating_ramp(**breathing_settings, info_from_user = False)),
+                    dcc.Graph(id='session-graph-hr', style={'width': '50%', 'display': 'inline-block'}),
+                    dcc.Graph(id='session-graph-coherence', style={'width': '50%', 'display': 'inline-block'}),
+                    dcc.Graph(id='breathing-scheme', figure=breathing_figure),
+                    html.Button('Start breathing', id='breathing-start-button', n_clicks=0),
+                    html.Button('Pause breathing', id='breathing-pause-button', n_clicks=0),
+                    dcc.Store(id='breathing-pacer', data=pacer),
+                    dcc.Interval(id='breathing-interval', interval=pacer_duration, n_intervals=0, disabled=True),
                     dcc.Interval(
                         id='interval-component',
                         interval= interval_value,  # in milliseconds
@@ -71,6 +390,8 @@ def run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval_value=
                             dbc.Input(id='ekg-range-1', value=chart_settings['ekg']['range'][0], type='number'),
                             dbc.Label('to'),
                             dbc.Input(id='ekg-range-2', value=chart_settings['ekg']['range'][1], type='number'),
+                            dbc.Label('EKG chart points (0 for all samples):'),
+                            dbc.Input(id='ekg-points-input', value=chart_settings['ekg']['points'], type='number', min=0, step=1),
                         ], width=6),
                         dbc.Col([
                             dbc.Label('HR chart y-axis range:'),
@@ -244,183 +565,311 @@ def run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval_value=
             hrv_analyzer.stop()
             return False
     
+    if replay is not None:
+        @app.callback(
+            Output('replay-position', 'children'),
+            [Input('replay-seek-button', 'n_clicks'),
+             Input('replay-previous-button', 'n_clicks'),
+             Input('replay-next-button', 'n_clicks'),
+             Input('replay-speed', 'value'),
+             Input('interval-component', 'n_intervals')],
+            [State('replay-time', 'value')]
+        )
+        def update_replay(seek_clicks, previous_clicks, next_clicks, speed, n, seek_time):
+            ctx = dash.callback_context
+            button_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
+
+            if button_id == 'replay-seek-button' and seek_time is not None:
+                replay.seek(seek_time)
+            elif button_id == 'replay-previous-button':
+                replay.previous_event()
+            elif button_id == 'replay-next-button':
+                replay.next_event()
+            elif button_id == 'replay-speed' and speed is not None:
+                replay.set_speed(speed)
+            return f" {replay.get_time():.1f} / {replay.get_duration():.1f} s"
+
+    # The breathing dot is moved in the browser, the server only starts and pauses the pacer
+    app.clientside_callback(
+        PACER_STEP_JS,
+        Output('breathing-scheme', 'extendData'),
+        Input('breathing-interval', 'n_intervals'),
+        State('breathing-pacer', 'data')
+    )
+
     @app.callback(
-        Output('live-graph-ekg', 'figure'),
-        Input('interval-component', 'n_intervals'),
-        State('running-state', 'data'),
-        Input('show-peaks-toggle', 'value'),
+        Output('breathing-interval', 'disabled'),
+        Output('breathing-interval', 'n_intervals'),
+        [Input('breathing-start-button', 'n_clicks'),
+         Input('breathing-pause-button', 'n_clicks')],
+        [State('breathing-interval', 'n_intervals')],
+        prevent_initial_call=True
     )
-    def update_EKG_plot(n, running_state, show_peaks):
-        if not running_state:
-            return dash.no_update
+    def update_breathing_state(start_clicks, pause_clicks, n_intervals):
+        ctx = dash.callback_context
+        button_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
-        data_buffer, time_buffer = signal_processor.get_data()
+        if button_id == 'breathing-start-button':
+            # A finished scheme starts again from the beginning
+            return False, 0 if n_intervals >= pacer['frames'] else dash.no_update
+        return True, dash.no_update
 
-        ekg_trace = go.Scatter(
-            x=time_buffer,
-            y=data_buffer,
-            mode='lines',
-            name=f'EKG Signal',
+    if incremental:
+        # Only data newer than what the client already has is sent: the EKG and HR traces are extended
+        # with extendData, HRV and coherence figures are sent only when a new result is available.
+        # A full figure is sent after a reset of the buffers or a change of the chart settings.
+        @app.callback(
+            Output('live-graph-ekg', 'figure'),
+            Output('live-graph-ekg', 'extendData'),
+            Output('ekg-stream-state', 'data'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data'),
+            Input('show-peaks-toggle', 'value'),
+            State('ekg-stream-state', 'data'),
         )
+        def stream_EKG_plot(n, running_state, show_peaks, stream_state):
+            if not running_state:
+                return dash.no_update, dash.no_update, dash.no_update
+
+            session = signal_processor.session
+            ekg_range = chart_settings['ekg']['range']
+            reset = (stream_state is None or stream_state['session'] != session
+                     or stream_state['range'] != ekg_range or stream_state['show_peaks'] != show_peaks)
+
+            data, time_data, sample_count = signal_processor.get_data_since(0 if reset else stream_state['sample'], peaks_detector.lead)
+
+            # Peaks inside the visible window, the ones not sent yet are appended to the markers trace
+            peaks = np.empty(0)
+            if 'show_peaks' in show_peaks and sample_count:
+                peaks, _ = peaks_detector.get_peaks()
+                window_start = time_data[-1] - signal_processor.buffor_size / signal_processor.sampling_rate if time_data.size else -np.inf
+                peaks = peaks[peaks >= window_start]
+
+            if reset:
+                new_state = {'session': session, 'sample': sample_count, 'range': list(ekg_range),
+                             'show_peaks': show_peaks, 'peak': float(peaks[-1]) if peaks.size else None}
+                return ekg_stream_figure(data, time_data, peaks), dash.no_update, new_state
+
+            new_peaks = peaks if stream_state['peak'] is None else peaks[peaks > stream_state['peak']]
+            if time_data.size == 0 and new_peaks.size == 0:
+                return dash.no_update, dash.no_update, dash.no_update
+
+            # Markers of the peaks that left the window are trimmed by the max points limit;
+            # a NaN-only segment keeps the trace valid when no peak is visible
+            peaks_x, peaks_y = peak_segments(new_peaks)
+            if peaks.size == 0:
+                peaks_x, peaks_y = np.full(3, np.nan), np.full(3, np.nan)
+            max_points = [signal_processor.buffor_size, 3 * max(peaks.size, 1)]
+
+            stream_state = dict(stream_state, sample=sample_count, peak=float(peaks[-1]) if peaks.size else stream_state['peak'])
+            extend_data = ({'x': [time_data, peaks_x], 'y': [data, peaks_y]}, [0, 1], {'x': max_points, 'y': max_points})
+            return dash.no_update, extend_data, stream_state
+
+        @app.callback(
+            Output('live-graph-hr', 'figure'),
+            Output('live-graph-hr', 'extendData'),
+            Output('hr-stream-state', 'data'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data'),
+            State('hr-stream-state', 'data'),
+        )
+        def stream_HR_plot(n, running_state, stream_state):
+            if not running_state:
+                return dash.no_update, dash.no_update, dash.no_update
+
+            session = signal_processor.session
+            hr_range = chart_settings['hr']['range']
+            reset = stream_state is None or stream_state['session'] != session or stream_state['range'] != hr_range
+
+            bpm, bpm_count = peaks_detector.get_bpm_since(0 if reset else stream_state['bpm'])
+            x = np.arange(bpm_count - len(bpm), bpm_count)
+            new_state = {'session': session, 'bpm': bpm_count, 'range': list(hr_range)}
+
+            if reset:
+                return hr_figure(bpm, x, binary=False), dash.no_update, new_state
+            if bpm.size == 0:
+                return dash.no_update, dash.no_update, dash.no_update
+            return dash.no_update, ({'x': [x], 'y': [bpm]}, [0], peaks_detector.peak_buffor_size), new_state
+
+        @app.callback(
+            Output('live-graph-hrv', 'figure'),
+            Output('hrv-stream-state', 'data'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data'),
+            State('hrv-stream-state', 'data'),
+        )
+        def stream_HRV_plot(n, running_state, stream_state):
+            if not running_state:
+                return dash.no_update, dash.no_update
+
+            new_state = {'session': signal_processor.session, 'version': hrv_analyzer.hrv_updated.version}
+            if new_state == stream_state:
+                return dash.no_update, dash.no_update
+            figure = shared_figure('hrv', new_state['session'], new_state['version'],
+                                   lambda: hrv_figure(hrv_analyzer.get_frequencies(), hrv_analyzer.get_power()))
+            return figure, new_state
+
+        @app.callback(
+            Output('live-graph-coherence', 'figure'),
+            Output('coherence-stream-state', 'data'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data'),
+            State('coherence-stream-state', 'data'),
+        )
+        def stream_coherence_plot(n, running_state, stream_state):
+            if not running_state:
+                return dash.no_update, dash.no_update
+
+            new_state = {'session': signal_processor.session, 'version': hrv_analyzer.coherence_updated.version}
+            if new_state == stream_state:
+                return dash.no_update, dash.no_update
+            figure = shared_figure('coherence', new_state['session'], new_state['version'],
+                                   lambda: coherence_figure(*hrv_analyzer.get_coherence()))
+            return figure, new_state
+
+    else:
+        @app.callback(
+            Output('live-graph-ekg', 'figure'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data'),
+            Input('show-peaks-toggle', 'value'),
+        )
+        def update_EKG_plot(n, running_state, show_peaks):
+            if not running_state:
+                return dash.no_update
+
+            show = 'show_peaks' in show_peaks
+            key = (signal_processor.session, peaks_detector.lead, show, tuple(chart_settings['ekg']['range']), chart_settings['ekg']['points'])
+            version = (signal_processor.data_updated.version, peaks_detector.peaks_updated.version if show else None)
+
+            def build():
+                data_buffer, time_buffer = signal_processor.get_data(peaks_detector.lead)
+                peaks = None
+                if show:
+                    peaks, _ = peaks_detector.get_peaks()
+                return ekg_figure(data_buffer, time_buffer, peaks, chart_settings['ekg']['points'])
+            return shared_figure('ekg', key, version, build)
+
+        @app.callback(
+            Output('live-graph-hr', 'figure'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data')
+        )
+        def update_HR_plot(n, running_state):
+            if not running_state:
+                return dash.no_update
+
+            key = (signal_processor.session, tuple(chart_settings['hr']['range']))
+            return shared_figure('hr', key, peaks_detector.bpm_count, lambda: hr_figure(peaks_detector.get_bpm()))
+
+
+        @app.callback(
+            Output('live-graph-hrv', 'figure'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data')
+        )
+        def update_HRV_plot(n, running_state):
+            if not running_state:
+                return dash.no_update
+
+            return shared_figure('hrv', signal_processor.session, hrv_analyzer.hrv_updated.version,
+                                 lambda: hrv_figure(hrv_analyzer.get_frequencies(), hrv_analyzer.get_power()))
+
+        @app.callback(
+            Output('live-graph-coherence', 'figure'),
+            Input('interval-component', 'n_intervals'),
+            State('running-state', 'data')
+        )
+        def update_coherence_plot(n, running_state):
+            if not running_state:
+                return dash.no_update
+
+            return shared_figure('coherence', signal_processor.session, hrv_analyzer.coherence_updated.version,
+                                 lambda: coherence_figure(*hrv_analyzer.get_coherence()))
 
-        shapes = []
-        if 'show_peaks' in show_peaks:
-            peaks, prominences = peaks_detector.get_peaks()
-            for peak, prominence in zip(peaks, prominences):
-                shapes.append(
-                    dict(
-                        type="line",
-                        x0=peak, y0=0,#data_buffer[int((peak - time_buffer[0])*processor.sampling_rate)] - prominence,
-                        x1=peak, y1=2000,#data_buffer[int((peak - time_buffer[0])*processor.sampling_rate)],
-                        line=dict(color="red", width=3)
-                    )
-            )
-        
-        return {
-            'data': [ekg_trace],
-            'layout': go.Layout(
-                title=f'Live EKG Data',
-                shapes=shapes,    
-                plot_bgcolor='white', 
-                paper_bgcolor='white',  
-                xaxis=dict(
-                    gridcolor='white',  
-                    linecolor='white',  
-                    range=[time_buffer[0], time_buffer[-1]]
-                ),
-                yaxis=dict(
-                    gridcolor='lightgrey', 
-                    linecolor='black',
-                    range=[chart_settings['ekg']['range'][0], chart_settings['ekg']['range'][1]]
-                )
-            )
-        }
-    
     @app.callback(
-        Output('live-graph-hr', 'figure'),
+        Output('latency-info', 'children'),
         Input('interval-component', 'n_intervals'),
         State('running-state', 'data')
     )
-    def update_HR_plot(n, running_state):
+    def update_latency_info(n, running_state):
         if not running_state:
             return dash.no_update
 
-        bpm = peaks_detector.get_bpm()
+        latency = hrv_analyzer.get_latency()
+        stages = []
+        for stage, label in (('peaks', 'R-peak'), ('hrv', 'HRV'), ('coherence', 'Coherence')):
+            if latency[stage]['mean'] is None:
+                stages.append(f'{label}: -')
+            else:
+                stages.append(f"{label}: {latency[stage]['mean']:.0f} ms (max {latency[stage]['max']:.0f} ms)")
+        info = 'Latency from R-peak arrival - ' + ', '.join(stages)
 
-        hr_trace = go.Scatter(
-            y=bpm,
-            mode='lines',
-            name='Heart Rate'
-        )
-        return {
-            'data': [hr_trace],
-            'layout': go.Layout(
-                title='Live Heart Rate',
-                plot_bgcolor='white',  
-                paper_bgcolor='white',  
-                xaxis=dict(
-                    gridcolor='lightgrey',  
-                    linecolor='black'  
-                ),
-                yaxis=dict(
-                    gridcolor='lightgrey',  
-                    linecolor='black', 
-                    range=[chart_settings['hr']['range'][0], chart_settings['hr']['range'][1]]
-                )
-            )
-        }
-    
+        acquisition_latency = signal_processor.get_acquisition_latency()
+        if acquisition_latency is not None:
+            info += f'. Acquisition to display: {acquisition_latency * 1000:.0f} ms'
+        return info
 
     @app.callback(
-        Output('live-graph-hrv', 'figure'),
+        Output('hrv-metrics', 'children'),
         Input('interval-component', 'n_intervals'),
         State('running-state', 'data')
     )
-    def update_HRV_plot(n, running_state):
+    def update_hrv_metrics(n, running_state):
         if not running_state:
             return dash.no_update
-        
-        F = hrv_analyzer.get_frequencies()
-        P = hrv_analyzer.get_power()
 
+        # Time-domain HRV over the sliding windows, kept up to date by the PeaksDetector with every beat
+        windows = []
+        for seconds, values in peaks_detector.get_hrv_metrics().items():
+            text = [f"{label} {values[key]:.0f}{unit}" if values[key] is not None else f"{label} -"
+                    for key, label, unit in (('mean_hr', 'HR', ' BPM'), ('sdnn', 'SDNN', ' ms'),
+                                             ('rmssd', 'RMSSD', ' ms'), ('pnn50', 'pNN50', '%'))]
+            window = f"{seconds / 60:g} min" if seconds >= 60 else f"{seconds:g} s"
+            windows.append(f"{window}: " + ', '.join(text))
+        return 'HRV - ' + '; '.join(windows)
 
-        if np.array_equal(F, np.array(None)) or np.array_equal(P, np.array(None)):
-            F = np.zeros(100)
-            P = np.linspace(0,1,100)
-        
-        F = F[::10]
-        P = P[::10]
-        
-        hrv_trace = go.Scatter(
-            x=F,
-            y=P,
-            mode='lines',
-            name='Heart Rate Variability'
-        )
-        
-        return {
-            'data': [hrv_trace],
-            'layout': go.Layout(
-                title='Live Heart Rate Variability',
-                plot_bgcolor='white',  
-                paper_bgcolor='white', 
-                xaxis=dict(
-                    gridcolor='lightgrey', 
-                    linecolor='black',
-                    range = [0,0.55]  # Range of frequencies
-                ),
-                yaxis=dict(
-                    gridcolor='lightgrey', 
-                    linecolor='black', 
-                    #range=[0,300] 
-                )
-            )
-        }
+    @app.callback(
+        Output('session-graph-hr', 'figure'),
+        Output('session-stream-state', 'data'),
+        Input('interval-component', 'n_intervals'),
+        State('running-state', 'data'),
+        State('session-stream-state', 'data'),
+    )
+    def update_session_HR_plot(n, running_state, stream_state):
+        if not running_state:
+            return dash.no_update, dash.no_update
+
+        # Redrawn only after new samples, i.e. about once per beat
+        history = peaks_detector.history
+        new_state = {'session': signal_processor.session, 'version': history.version}
+        if new_state == stream_state:
+            return dash.no_update, dash.no_update
+        figure = shared_figure('session_hr', new_state['session'], new_state['version'],
+                               lambda: session_hr_figure(*history.get()))
+        return figure, new_state
 
     @app.callback(
-        Output('live-graph-coherence', 'figure'),
+        Output('session-graph-coherence', 'figure'),
+        Output('trend-stream-state', 'data'),
         Input('interval-component', 'n_intervals'),
-        State('running-state', 'data')
+        State('running-state', 'data'),
+        State('trend-stream-state', 'data'),
     )
-    def update_coherence_plot(n, running_state):
+    def update_coherence_trend_plot(n, running_state, stream_state):
         if not running_state:
-            return dash.no_update
-        
-        x, coh = hrv_analyzer.get_coherence()
-        
-        if np.array_equal(coh, np.array(None)) :
-            coh = np.zeros(len(x))
-        
-        x = x[::10]
-        coh = coh[::10]
+            return dash.no_update, dash.no_update
+
+        # The trend and the summary are kept by the HRVAnalyzer with every new coherence value
+        new_state = {'session': signal_processor.session, 'version': hrv_analyzer.coherence_updated.version}
+        if new_state == stream_state:
+            return dash.no_update, dash.no_update
+        figure = shared_figure('coherence_trend', new_state['session'], new_state['version'],
+                               lambda: coherence_trend_figure(peaks_detector.history.start_time,
+                                                              *hrv_analyzer.get_coherence_trend(),
+                                                              hrv_analyzer.get_coherence_summary()))
+        return figure, new_state
 
-        coherence_trace = go.Scatter(
-            x=x,
-            y=coh,
-            mode='lines',
-            name='Coherence'
-        )
-        
-        return {
-            'data': [coherence_trace],
-            'layout': go.Layout(
-                title='Coherence',
-                plot_bgcolor='white',
-                paper_bgcolor='white',  
-                xaxis=dict(
-                    gridcolor='lightgrey',  
-                    linecolor='lightgray',
-                    range = [-4,4],  
-                    showticklabels=False
-                ),
-                yaxis=dict(
-                    gridcolor='lightgrey',  
-                    linecolor='lightgray',  
-                    range=[0,1]  
-                )
-            )
-        }
-    
     @app.callback(
         Output('dummy-output', 'children'),
         [Input('sampling-rate-input', 'value'),
@@ -428,6 +877,7 @@ def run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval_value=
         Input('hr-range-2', 'value'),
         Input('ekg-range-1', 'value'),
         Input('ekg-range-2', 'value'),
+        Input('ekg-points-input', 'value'),
         Input('hp-order-input', 'value'),
         Input('hp-fc-input', 'value'),
         Input('hp-rp-input', 'value'),
@@ -446,7 +896,7 @@ def run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval_value=
     )
     def save_settings(
             sampling_rate,
-            hr_low, hr_high, ekg_low, ekg_high,
+            hr_low, hr_high, ekg_low, ekg_high, ekg_points,
             hp_order, hp_fc, hp_rp, hp_rs,
             lp_order, lp_fc, lp_rp, lp_rs,
             notch_f0, notch_q,
@@ -458,6 +908,9 @@ def run_dash_app(signal_processor, peaks_detector, hrv_analyzer, interval_value=
         chart_settings['hr']['range'][1] = hr_high
         chart_settings['ekg']['range'][0] = ekg_low
         chart_settings['ekg']['range'][1] = ekg_high
+        # A whole number of samples, 0 (all samples) or at least one min/max pair
+        ekg_points = int(ekg_points or 0)
+        chart_settings['ekg']['points'] = 0 if ekg_points <= 0 else max(ekg_points, 2)
         signal_processor.hp_params = {'order': hp_order, 'fc': hp_fc, 'rp': hp_rp, 'rs': hp_rs}
         signal_processor.lp_params = {'order': lp_order, 'fc': lp_fc, 'rp': lp_rp, 'rs': lp_rs}
         signal_processor.notch_params = {'f0': notch_f0, 'Q': notch_q}
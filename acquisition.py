@@ -0,0 +1,340 @@
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import EKGProcessor as ekgp
+from ring_buffer import RingBuffer
+
+# Counters at the start of the shared memory block. `sequence` and `peaks_sequence` are the seqlock
+# counters of the signal buffers and of the peaks, odd while the acquisition process is writing
+HEADER = ['sequence', 'sample_count', 'session', 'running', 'total_samples', 'total_chunks',
+          'data_written', 'time_written', 'chunk_end_written', 'chunk_arrival_written',
+          'peaks_sequence', 'peaks_written', 'prominence_written', 'peaks_session']
+FIELD = {name: index for index, name in enumerate(HEADER)}
+
+class SharedRingBuffer(RingBuffer):
+    """RingBuffer over an array in shared memory, with its write counter in the shared header."""
+
+    def __init__(self, buffer, header, index):
+        self.capacity = len(buffer)
+        self.channels = buffer.shape[1] if buffer.ndim == 2 else None
+        self.buffer = buffer
+        self.header = header
+        self.index = index
+
+    @property
+    def written(self):
+        return int(self.header[self.index])
+
+    @written.setter
+    def written(self, value):
+        self.header[self.index] = value
+
+class SharedBuffers:
+    """Shared memory block with the signal buffers of a SignalProcessor and the R-peaks found in them.
+    Created by the UI process (name=None) and attached to by the acquisition process."""
+
+    def __init__(self, capacity, channels=None, chunks=1024, peaks=1024, name=None):
+        self.capacity = capacity
+        self.channels = channels
+        self.chunks = chunks
+        self.peaks = peaks
+
+        arrays = [('header', (len(HEADER),), np.int64),
+                  ('data', (capacity,) if channels is None else (capacity, channels), np.float64),
+                  ('time', (capacity,), np.float64),
+                  ('chunk_end_time', (chunks,), np.float64),
+                  ('chunk_arrival', (chunks,), np.float64),
+                  ('peaks_time', (peaks,), np.float64),
+                  ('peaks_prominence', (peaks,), np.float64)]
+        size = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in arrays)
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+
+        views = {}
+        offset = 0
+        for array_name, shape, dtype in arrays:
+            views[array_name] = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset)
+            offset += views[array_name].nbytes
+        self.header = views['header']
+        if name is None:
+            self.header[:] = 0
+
+        self.data_buffer = SharedRingBuffer(views['data'], self.header, FIELD['data_written'])
+        self.time_buffer = SharedRingBuffer(views['time'], self.header, FIELD['time_written'])
+        self.chunk_end_time = SharedRingBuffer(views['chunk_end_time'], self.header, FIELD['chunk_end_written'])
+        self.chunk_arrival = SharedRingBuffer(views['chunk_arrival'], self.header, FIELD['chunk_arrival_written'])
+        self.peaks_time = SharedRingBuffer(views['peaks_time'], self.header, FIELD['peaks_written'])
+        self.peaks_prominence = SharedRingBuffer(views['peaks_prominence'], self.header, FIELD['prominence_written'])
+
+    def spec(self):
+        """Arguments recreating this block in another process."""
+        return self.capacity, self.channels, self.chunks, self.peaks, self.memory.name
+
+    def publish_peaks(self, peaks, prominences, session):
+        """Appends R-peaks found in the signal buffers of `session`. Peaks of an earlier session are dropped first."""
+        header = self.header
+        header[FIELD['peaks_sequence']] += 1
+        if header[FIELD['peaks_session']] != session:
+            self.peaks_time.clear()
+            self.peaks_prominence.clear()
+            header[FIELD['peaks_session']] = session
+        self.peaks_time.extend(peaks)
+        self.peaks_prominence.extend(prominences)
+        header[FIELD['peaks_sequence']] += 1
+
+    def read_peaks(self, cursor, session):
+        """R-peaks of `session` published after the first `cursor` ones, their prominences and the cursor
+        to pass in the next call. Nothing is returned while the published peaks belong to another session."""
+        header = self.header
+        while True:
+            sequence = int(header[FIELD['peaks_sequence']])
+            if not sequence & 1:
+                if header[FIELD['peaks_session']] != session:
+                    peaks, prominences, written = np.empty(0), np.empty(0), 0
+                else:
+                    written = self.peaks_time.written
+                    new_peaks = written - cursor
+                    if new_peaks < 0:
+                        new_peaks = written
+                    peaks = self.peaks_time.snapshot(new_peaks)
+                    prominences = self.peaks_prominence.snapshot(new_peaks)
+                if header[FIELD['peaks_sequence']] == sequence:
+                    return peaks, prominences, written
+            time.sleep(0)
+
+    def unlink(self):
+        self.memory.unlink()
+
+def shared_field(name):
+    # Attribute of a SignalProcessor kept in the shared header instead of the instance
+    index = FIELD[name]
+
+    def get(self):
+        return int(self.shared.header[index])
+
+    def set(self, value):
+        self.shared.header[index] = value
+    return property(get, set)
+
+class SharedStateProcessor(ekgp.SignalProcessor):
+    """SignalProcessor with its buffers and counters in a SharedBuffers block."""
+    sequence = shared_field('sequence')
+    sample_count = shared_field('sample_count')
+    session = shared_field('session')
+    running = shared_field('running')
+    total_samples = shared_field('total_samples')
+    total_chunks = shared_field('total_chunks')
+
+    def attach_buffers(self):
+        self.data_buffer = self.shared.data_buffer
+        self.time_buffer = self.shared.time_buffer
+        self.chunk_end_time = self.shared.chunk_end_time
+        self.chunk_arrival = self.shared.chunk_arrival
+
+class AcquisitionSignalProcessor(SharedStateProcessor):
+    """The SignalProcessor running in the acquisition process, writing to the shared buffers."""
+
+    def __init__(self, shared, inlet, **settings):
+        self.shared = shared
+        super().__init__(inlet, **settings)
+        self.attach_buffers()
+        self.data_thread = None
+
+class SharedSignalProcessor(SharedStateProcessor):
+    """Stand-in for the SignalProcessor in the UI process. The buffers are read straight from the shared
+    memory with the same lock-free snapshots; start, stop and the filter settings are sent to the
+    acquisition process. Listeners get the filtered chunks (as both new_data and filtered_data),
+    the raw samples stay in the acquisition process."""
+
+    def __init__(self, shared, control, poll_interval=0.002, **settings):
+        self.shared = shared
+        self.control = control
+        self.poll_interval = poll_interval
+        self.watching = False
+        self.data_thread = None
+        super().__init__(None, **settings)
+        self.attach_buffers()
+
+    def update_filters(self):
+        self.control.request('filters', self.sampling_rate, self.hp_params, self.lp_params, self.notch_params)
+
+    def get_backlog(self):
+        return None
+
+    def watch_data(self):
+        # The acquisition process cannot notify threads of this process, so its chunk counter is polled
+        total_chunks = self.total_chunks
+        sample_index = self.sample_count
+        while self.watching:
+            time.sleep(self.poll_interval)
+            if self.total_chunks == total_chunks:
+                continue
+            total_chunks = self.total_chunks
+            self.data_updated.notify()
+            if self.listeners:
+                data, time_data, sample_index = self.get_data_since(sample_index)
+                for listener in self.listeners:
+                    listener(data, data, time_data)
+
+    def start(self):
+        if not self.running:
+            self.control.request('start')
+            if not self.watching:
+                self.watching = True
+                self.data_thread = threading.Thread(target=self.watch_data, daemon=True)
+                self.data_thread.start()
+
+    def stop(self):
+        self.control.request('stop')
+        self.watching = False
+        if self.data_thread is not None:
+            self.data_thread.join()
+
+class SharedPeaksDetector(ekgp.PeaksDetector):
+    """Stand-in for the PeaksDetector in the UI process when the R-peaks are detected in the acquisition
+    process: update_peaks takes the newly published peaks instead of searching the signal. RR intervals,
+    BPM and peak listeners work as in PeaksDetector; the find_peaks settings and the lead are sent to
+    the acquisition process."""
+
+    def __init__(self, signal_processor, shared, control, find_peaks_setting=None, detector='batch', lead=0, pipeline='polling'):
+        self.shared = shared
+        self.control = control
+        self.peaks_cursor = 0
+        # Only the thread reading the published peaks runs here, `detector` is used by the acquisition process
+        super().__init__(signal_processor, find_peaks_setting, detector='batch', lead=lead, pipeline=pipeline)
+
+    @property
+    def find_peaks_setting(self):
+        return self.peaks_settings
+
+    @find_peaks_setting.setter
+    def find_peaks_setting(self, settings):
+        self.peaks_settings = settings
+        self.control.request('find_peaks', settings)
+
+    def set_lead(self, lead):
+        super().set_lead(lead)
+        self.control.request('lead', lead)
+
+    def update_peaks(self):
+        self.check_session()
+        peaks, prominences, self.peaks_cursor = self.shared.read_peaks(self.peaks_cursor, self.session)
+        if peaks.size:
+            self.add_peaks(peaks, prominences)
+
+    def reset_peaks(self):
+        super().reset_peaks()
+        self.peaks_cursor = 0
+
+class Control:
+    """Request-reply channel to the acquisition process."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def request(self, *command):
+        with self.lock:
+            self.connection.send(command)
+            reply = self.connection.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+def run_acquisition(spec, connection, make_inlet, settings, peaks_settings, record):
+    """Entry point of the acquisition process: serves the requests of the UI process until 'close'."""
+    shared = SharedBuffers(*spec[:4], name=spec[4])
+    processor = AcquisitionSignalProcessor(shared, make_inlet(), **settings)
+    peaks_detector = None
+    if peaks_settings is not None:
+        peaks_detector = ekgp.PeaksDetector(processor, **peaks_settings)
+        peaks_detector.add_peak_listener(
+            lambda peaks, prominences, rr_intervals: shared.publish_peaks(peaks, prominences, peaks_detector.session))
+
+    recorder = None
+    if record is not None:
+        from recorder import SessionRecorder
+        recorder = SessionRecorder(record, processor, peaks_detector)
+        recorder.start()
+
+    try:
+        while True:
+            try:
+                command, *args = connection.recv()
+            except EOFError:
+                # The UI process is gone
+                break
+            try:
+                reply = None
+                if command == 'start':
+                    processor.start()
+                    if peaks_detector is not None:
+                        peaks_detector.start()
+                elif command == 'stop':
+                    if peaks_detector is not None and peaks_detector.running:
+                        peaks_detector.stop()
+                    if processor.data_thread is not None:
+                        processor.stop()
+                elif command == 'filters':
+                    processor.sampling_rate, processor.hp_params, processor.lp_params, processor.notch_params = args
+                    processor.update_filters()
+                elif command == 'find_peaks':
+                    if peaks_detector is not None:
+                        peaks_detector.find_peaks_setting = args[0]
+                elif command == 'lead':
+                    if peaks_detector is not None:
+                        peaks_detector.set_lead(args[0])
+            except Exception as error:
+                reply = error
+            connection.send(reply)
+            if command == 'close':
+                break
+    finally:
+        if peaks_detector is not None and peaks_detector.running:
+            peaks_detector.stop()
+        if processor.data_thread is not None:
+            processor.stop()
+        if recorder is not None:
+            recorder.stop()
+            print(f"Session saved to {record}: {recorder.written_chunks} chunks written, {recorder.dropped_chunks} dropped")
+
+class AcquisitionProcess:
+    """Runs the SignalProcessor, and with `peaks_settings` also the PeaksDetector, in a separate process,
+    so acquisition and filtering never wait for the GIL held by the Dash callbacks.
+
+    The acquisition process writes the filtered samples, their timestamps and the R-peaks to ring buffers
+    in shared memory; `signal_processor` and `peaks_detector` are the stand-ins used by the UI process,
+    which read them without pickling. `make_inlet` is a picklable callable creating the inlet in the
+    acquisition process, e.g. functools.partial(test_signal.test_signal, path)."""
+
+    def __init__(self, make_inlet, settings, peaks_settings=None, record=None):
+        capacity = settings.get('sampling_rate', 500) * settings.get('buffor_size_seconds', 5)
+        channels = settings.get('channels')
+        self.shared = SharedBuffers(capacity, None if channels is None else len(channels))
+
+        # A fresh interpreter, the threads of this process are not forked along
+        context = multiprocessing.get_context('spawn')
+        connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_acquisition, name='acquisition', daemon=True,
+                                       args=(self.shared.spec(), child_connection, make_inlet, settings, peaks_settings, record))
+        self.process.start()
+        # Only the acquisition process holds its end, so the requests fail instead of hanging if it dies
+        child_connection.close()
+        self.control = Control(connection)
+
+        try:
+            self.signal_processor = SharedSignalProcessor(self.shared, self.control, **settings)
+            self.peaks_detector = None
+            if peaks_settings is not None:
+                self.peaks_detector = SharedPeaksDetector(self.signal_processor, self.shared, self.control, **peaks_settings)
+        except Exception:
+            # The acquisition process failed to start, e.g. the inlet could not be opened
+            self.shared.unlink()
+            raise
+
+    def close(self):
+        if self.process.is_alive():
+            self.control.request('close')
+            self.process.join(5)
+        self.shared.unlink()
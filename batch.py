@@ -0,0 +1,68 @@
+import EKGProcessor as ekgp
+import test_signal as ts
+import numpy as np
+import time
+
+def run_batch(s_path, out_path, n_ch=1, channel=0, channel_base=-1, fs=500, dtype='<f', step=1, block_seconds=60, estimator='fft'):
+    """Runs a whole recording through the SignalProcessor -> PeaksDetector -> HRVAnalyzer chain as fast
+    as possible and saves RR intervals, BPM, HRV spectra and coherence over time to `out_path` (.npz)."""
+    start = time.perf_counter()
+    processor = ekgp.SignalProcessor(inlet=None, sampling_rate=fs, mode='offline')
+    peaks_detector = ekgp.PeaksDetector(processor)
+    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector, estimator=estimator)
+
+    # Filtering in large blocks with the same filter cascade as in the live mode
+    source = ts.test_signal(s_path, n_ch=n_ch, dtype=dtype, channel=channel, channel_base=channel_base,
+                            fs=fs, chunk_size=block_seconds * fs, realtime=False)
+    filtered = np.concatenate([processor.filter_data(block) for block in source])
+    duration = len(filtered) / fs
+
+    # One find_peaks pass over the whole signal; the live detector never accepts a peak within 0.2 s of the last one
+    peaks, prominences = peaks_detector.detect_peaks(filtered, distance=max(int(0.2 * fs), 1))
+    peaks_time = (peaks + 1) / fs # the same time axis as SignalProcessor.time_buffer
+    rr_intervals = np.diff(peaks_time)
+
+    # BPM after every beat, as the mean over the last five RR intervals
+    beats = np.arange(1, len(rr_intervals) + 1)
+    window = np.minimum(beats, 5)
+    bpm_sum = np.concatenate(([0], np.cumsum(60.0 / rr_intervals)))
+    bpm = (bpm_sum[beats] - bpm_sum[beats - window]) / window
+
+    # HRV spectrum and coherence every `step` seconds over the analysis window of the HRVAnalyzer (the peaks
+    # from the one before the window start), recomputed only when new beats have arrived since the previous step
+    hrv_frequencies = np.linspace(0, 0.5, 501)
+    hrv_time = np.arange(step, duration + step / 2, step)
+    peaks_end = np.searchsorted(peaks_time, hrv_time, side='right')
+    hrv_power = np.full((len(hrv_time), len(hrv_frequencies)), np.nan)
+    coherence = np.full(len(hrv_time), np.nan)
+
+    last_end = None
+    for i, end in enumerate(peaks_end):
+        if end < 11:
+            continue
+        if end != last_end:
+            window_start = peaks_time[end - 2] - hrv_analyzer.window_length / hrv_analyzer.tachogram_fs
+            begin = max(np.searchsorted(peaks_time, window_start, side='right') - 1, 0)
+            window_peaks = peaks_time[begin:end]
+            F, P = hrv_analyzer.hrv_spectrum(window_peaks, np.diff(window_peaks))
+            power = np.interp(hrv_frequencies, F, P, left=np.nan, right=np.nan)
+            coherence_value = hrv_analyzer.coherence_ratio(F, P)
+            last_end = end
+        hrv_power[i] = power
+        coherence[i] = coherence_value
+
+    np.savez_compressed(out_path,
+                        peaks_time=peaks_time,
+                        peaks_prominence=prominences,
+                        rr_intervals=rr_intervals,
+                        bpm_time=peaks_time[1:],
+                        bpm=bpm,
+                        hrv_time=hrv_time,
+                        hrv_frequencies=hrv_frequencies,
+                        hrv_power=hrv_power,
+                        coherence_time=hrv_time,
+                        coherence=coherence)
+
+    elapsed = time.perf_counter() - start
+    print(f"Analysed {duration:.1f} s of signal in {elapsed:.2f} s ({duration / elapsed:.0f}x real time), "
+          f"{len(peaks_time)} peaks. Results saved to {out_path}")
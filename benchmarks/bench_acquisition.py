@@ -0,0 +1,81 @@
+"""Acquisition timing under load in the UI process: the SignalProcessor in a thread of the UI process vs. in
+a separate acquisition process (acquisition.AcquisitionProcess). The signal is replayed in real time while
+`load` threads keep rebuilding and serialising the EKG figure like the Dash callbacks; the lateness of every
+chunk is its arrival in the buffers relative to the replay schedule."""
+import argparse
+import functools
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from plotly.io.json import to_json_plotly
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import EKGProcessor as ekgp
+import EKGapp
+from replay import ReplaySource
+
+
+def ui_load(processor, done, counter):
+    # What an EKG chart callback does: a buffer snapshot, the figure and its JSON serialisation
+    while not done.is_set():
+        data, time_data = processor.get_data()
+        if time_data.size:
+            to_json_plotly(EKGapp.ekg_figure(data, time_data, time_data[::400]))
+        counter[0] += 1
+
+
+def bench(acquisition, n_load, s_path, seconds, chunk_size):
+    make_inlet = functools.partial(ReplaySource, s_path, chunk_size=chunk_size)
+    settings = dict(samps_per_chunk=chunk_size, sampling_rate=500, buffor_size_seconds=5, mode='offline')
+    process = None
+    if acquisition == 'thread':
+        processor = ekgp.SignalProcessor(inlet=make_inlet(), **settings)
+    else:
+        from acquisition import AcquisitionProcess
+        process = AcquisitionProcess(make_inlet, settings)
+        processor = process.signal_processor
+
+    done = threading.Event()
+    counter = [0]
+    threads = [threading.Thread(target=ui_load, args=(processor, done, counter)) for _ in range(n_load)]
+    processor.start()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    done.set()
+    for thread in threads:
+        thread.join()
+
+    end_time = processor.chunk_end_time.snapshot()
+    arrival = processor.chunk_arrival.snapshot()
+    processor.stop()
+    if process is not None:
+        process.close()
+
+    # Arrival relative to the schedule of the replay, the earliest chunk taken as on time
+    lateness = (arrival - arrival[0]) - (end_time - end_time[0])
+    lateness = (lateness - lateness.min()) * 1e3
+    return np.percentile(lateness, 50), np.percentile(lateness, 99), lateness.max(), counter[0] / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Acquisition thread vs. process benchmark")
+    parser.add_argument('--s_path', type=str, default=os.path.join(ROOT, 'test_perun.raw'))
+    parser.add_argument('--load', type=str, default='0,2,8', help="Numbers of UI load threads, comma separated")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--chunk_size', type=int, default=16)
+    args = parser.parse_args()
+
+    print(f"{'acquisition':>11} {'load':>5} {'lateness p50 [ms]':>18} {'p99 [ms]':>9} {'max [ms]':>9} {'figures/s':>10}")
+    for n_load in (int(n) for n in args.load.split(',')):
+        for acquisition in ('thread', 'process'):
+            p50, p99, worst, figures = bench(acquisition, n_load, args.s_path, args.seconds, args.chunk_size)
+            print(f"{acquisition:>11} {n_load:>5} {p50:>18.1f} {p99:>9.1f} {worst:>9.1f} {figures:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Build time and payload of the breathing scheme: the animation-frames figure vs. the browser-driven pacer."""
+import argparse
+import json
+import os
+import sys
+import time
+
+from plotly.io.json import to_json_plotly
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import breath
+import EKGapp
+import EKGProcessor as ekgp
+
+
+def bench(build, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = build()
+        times.append(time.perf_counter() - start)
+    return min(times), len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Breathing pacer startup benchmark")
+    parser.add_argument('--breathing', type=str, default='{"hold_zero":15, "inhale":10, "hold_one":15, "exhale":10, "speed":-3, "loops":10}')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    settings = json.loads(args.breathing)
+
+    ramp_time, ramp_size = bench(lambda: to_json_plotly(breath.creating_ramp(**settings)), args.repeat)
+
+    def pacer():
+        fig, params, _ = breath.creating_pacer(**settings)
+        return to_json_plotly(fig) + json.dumps(params)
+    pacer_time, pacer_size = bench(pacer, args.repeat)
+
+    # Whole dashboard startup with the pacer: app creation and the layout sent to the browser
+    processor = ekgp.SignalProcessor(inlet=None, mode='offline')
+    peaks_detector = ekgp.PeaksDetector(processor)
+    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector)
+
+    def app_layout():
+        app = EKGapp.run_dash_app(processor, peaks_detector, hrv_analyzer, **settings)
+        return app.server.test_client().get('/_dash-layout').data
+    app_time, app_size = bench(app_layout, args.repeat)
+
+    print(f"{'':>22} {'build+json [ms]':>16} {'payload [KB]':>13}")
+    print(f"{'creating_ramp':>22} {ramp_time * 1e3:>16.1f} {ramp_size / 1024:>13.1f}")
+    print(f"{'creating_pacer':>22} {pacer_time * 1e3:>16.1f} {pacer_size / 1024:>13.1f}")
+    print(f"{'dashboard layout':>22} {app_time * 1e3:>16.1f} {app_size / 1024:>13.1f}")
+    print(f"speedup: {ramp_time / pacer_time:.0f}x, payload reduction: {ramp_size / pacer_size:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
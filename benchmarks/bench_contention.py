@@ -0,0 +1,88 @@
+"""Writer latency of SignalProcessor.add_data with concurrent buffer readers: lock-free seqlock snapshots
+shared between readers (get_data) vs. every reader copying the buffers while holding data_lock, as get_data
+did before. The writer is paced at `speed` times the real-time chunk rate."""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import EKGProcessor as ekgp
+
+
+def locked_get_data(processor):
+    with processor.data_lock:
+        return processor.data_buffer.snapshot(), processor.time_buffer.snapshot()
+
+
+def bench(reader_kind, n_readers, fs, chunk_size, buffer_seconds, n_leads, n_chunks, reader_interval, speed):
+    channels = list(range(n_leads)) if n_leads > 1 else None
+    processor = ekgp.SignalProcessor(inlet=None, samps_per_chunk=chunk_size, sampling_rate=fs,
+                                     buffor_size_seconds=buffer_seconds, mode='offline', channels=channels)
+    shape = (chunk_size, n_leads) if channels else chunk_size
+    chunk = np.random.default_rng(0).standard_normal(shape) * 100
+    for _ in range(fs * buffer_seconds // chunk_size):
+        processor.add_data(chunk)
+
+    read = processor.get_data if reader_kind == 'seqlock' else lambda: locked_get_data(processor)
+    done = threading.Event()
+    reads = [0] * n_readers
+
+    def reader(i):
+        while not done.is_set():
+            data, time_data = read()
+            reads[i] += 1
+            if reader_interval:
+                time.sleep(reader_interval)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(n_readers)]
+    for thread in threads:
+        thread.start()
+
+    durations = np.empty(n_chunks)
+    period = chunk_size / (fs * speed)
+    start = time.perf_counter()
+    for i in range(n_chunks):
+        t = time.perf_counter()
+        processor.add_data(chunk)
+        durations[i] = time.perf_counter() - t
+        time.sleep(max(start + (i + 1) * period - time.perf_counter(), 0))
+    elapsed = time.perf_counter() - start
+    done.set()
+    for thread in threads:
+        thread.join()
+
+    durations *= 1e6
+    return (np.percentile(durations, 50), np.percentile(durations, 99), durations.max(),
+            sum(reads) / elapsed, processor.snapshot_retries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Buffer snapshot contention benchmark")
+    parser.add_argument('--readers', type=str, default='0,1,4,16')
+    parser.add_argument('--fs', type=int, default=500)
+    parser.add_argument('--chunk_size', type=int, default=16)
+    parser.add_argument('--buffer_seconds', type=int, default=20)
+    parser.add_argument('--leads', type=str, default='1,32', help="Lead counts, more leads make every snapshot longer")
+    parser.add_argument('--chunks', type=int, default=1000)
+    parser.add_argument('--speed', type=float, default=10, help="Writer pace relative to real time")
+    parser.add_argument('--reader_interval', type=float, default=0.001, help="Pause between reads of one reader, 0 to spin")
+    args = parser.parse_args()
+
+    print(f"{'leads':>5} {'readers':>7} {'kind':>8} {'add_data p50 [us]':>18} {'p99 [us]':>9} {'max [us]':>9} "
+          f"{'reads/s':>8} {'retries':>8}")
+    for n_leads in (int(n) for n in args.leads.split(',')):
+        for n_readers in (int(n) for n in args.readers.split(',')):
+            for kind in ('locked', 'seqlock'):
+                p50, p99, worst, read_rate, retries = bench(
+                    kind, n_readers, args.fs, args.chunk_size, args.buffer_seconds, n_leads, args.chunks,
+                    args.reader_interval, args.speed)
+                print(f"{n_leads:>5} {n_readers:>7} {kind:>8} {p50:>18.1f} {p99:>9.1f} {worst:>9.0f} "
+                      f"{read_rate:>8.0f} {retries:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Per-chunk cost of the fused SOS cascade vs. the previous three-stage lfilter path."""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+from scipy import signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import EKGProcessor as ekgp
+
+
+class ThreeStageFilter:
+    """The high-pass, low-pass and notch filters applied one after another in transfer-function form."""
+
+    def __init__(self, processor):
+        hp, lp, notch, fs = processor.hp_params, processor.lp_params, processor.notch_params, processor.sampling_rate
+        self.b_h, self.a_h = signal.iirfilter(hp['order'], hp['fc'], hp['rp'], hp['rs'],
+                                              btype='highpass', ftype='butter', output='ba', fs=fs)
+        self.b_l, self.a_l = signal.iirfilter(lp['order'], lp['fc'], lp['rp'], rs=lp['rs'],
+                                              btype='lowpass', ftype='butter', output='ba', fs=fs)
+        self.b_n, self.a_n = signal.iirnotch(notch['f0'], Q=notch['Q'], fs=fs)
+        self.zi_h = signal.lfilter_zi(self.b_h, self.a_h)
+        self.zi_l = signal.lfilter_zi(self.b_l, self.a_l)
+        self.zi_n = signal.lfilter_zi(self.b_n, self.a_n)
+
+    def filter_data(self, new_data):
+        filtered_data, self.zi_h = signal.lfilter(self.b_h, self.a_h, new_data, zi=self.zi_h)
+        filtered_data, self.zi_l = signal.lfilter(self.b_l, self.a_l, filtered_data, zi=self.zi_l)
+        filtered_data, self.zi_n = signal.lfilter(self.b_n, self.a_n, filtered_data, zi=self.zi_n)
+        return filtered_data
+
+
+def bench(fs, chunk_size, repeat):
+    processor = ekgp.SignalProcessor(inlet=None, samps_per_chunk=chunk_size, sampling_rate=fs, mode='offline')
+    legacy = ThreeStageFilter(processor)
+    chunk = np.random.default_rng(0).standard_normal(chunk_size) * 100
+
+    sos, _ = processor.filter_state
+    zi = signal.sosfilt_zi(sos)
+
+    def public_sosfilt():
+        nonlocal zi
+        _, zi = signal.sosfilt(sos, chunk, zi=zi)
+
+    ba_time = min(timeit.repeat(lambda: legacy.filter_data(chunk), number=1000, repeat=repeat)) / 1000
+    public_time = min(timeit.repeat(public_sosfilt, number=1000, repeat=repeat)) / 1000
+    sos_time = min(timeit.repeat(lambda: processor.filter_data(chunk), number=1000, repeat=repeat)) / 1000
+    return ba_time, public_time, sos_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter cascade micro-benchmark")
+    parser.add_argument('--chunk_size', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [(fs, *bench(fs, args.chunk_size, args.repeat)) for fs in (500, 2000, 8000)]
+
+    print(f"{'Fs [Hz]':>8} {'3x lfilter [us]':>16} {'signal.sosfilt [us]':>20} {'filter_data [us]':>17} {'speedup':>8}")
+    for fs, ba_time, public_time, sos_time in results:
+        print(f"{fs:>8} {ba_time * 1e6:>16.2f} {public_time * 1e6:>20.2f} {sos_time * 1e6:>17.2f} {ba_time / sos_time:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""HRV spectrum estimators: periodogram of the RR tachogram resampled at 1 Hz (estimator='fft') vs. Lomb-Scargle
+periodogram of the RR intervals at the beat times (estimator='lomb').
+
+Cost: the R-peaks of test_perun.raw (tiled to --seconds) are fed beat by beat to a PeaksDetector and
+HRVAnalyzer.calculate_hrv is timed after every beat, like the live analysis thread.
+Accuracy: on the synthetic ECG of the benchmark suite, with the RR intervals modulated at 0.1 Hz, the error of
+the spectrum peak frequency and the coherence, with all the beats and with a fraction of them missed by the
+detector (the RR interval spanning two beats)."""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import EKGProcessor as ekgp
+from suite import perun_ecg, synthetic_ecg
+
+ESTIMATORS = ('fft', 'lomb')
+
+
+def detect_peaks(x, fs):
+    """R-peak times of the whole signal, found like in batch mode."""
+    processor = ekgp.SignalProcessor(inlet=None, sampling_rate=fs, mode='offline')
+    peaks_detector = ekgp.PeaksDetector(processor)
+    peaks, _ = peaks_detector.detect_peaks(processor.filter_data(x), distance=max(int(0.2 * fs), 1))
+    return (peaks + 1) / fs
+
+
+def live_cost(peaks_time, fs, estimator):
+    """calculate_hrv durations in microseconds after every new beat."""
+    processor = ekgp.SignalProcessor(inlet=None, sampling_rate=fs, mode='offline')
+    peaks_detector = ekgp.PeaksDetector(processor)
+    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector, estimator=estimator)
+    durations = []
+    for i, peak in enumerate(peaks_time):
+        if i:
+            peaks_detector.rr_intervals.append(peak - peaks_time[i - 1])
+        peaks_detector.peaks_time.append(peak)
+        start = time.perf_counter()
+        hrv_analyzer.calculate_hrv()
+        durations.append(time.perf_counter() - start)
+    return np.array(durations[11:]) * 1e6
+
+
+def spectra(peaks_time, fs, estimator, step=5):
+    """Peak frequency in 0.04-0.26 Hz and coherence every `step` beats once the analysis window is full."""
+    processor = ekgp.SignalProcessor(inlet=None, sampling_rate=fs, mode='offline')
+    hrv_analyzer = ekgp.HRVAnalyzer(ekgp.PeaksDetector(processor), estimator=estimator)
+    start = np.searchsorted(peaks_time, peaks_time[0] + hrv_analyzer.window_seconds + 2)
+    frequencies, coherence = [], []
+    for end in range(start, len(peaks_time) + 1, step):
+        window_peaks = peaks_time[:end][peaks_time[:end] >= peaks_time[end - 1] - hrv_analyzer.window_seconds - 2]
+        F, P = hrv_analyzer.hrv_spectrum(window_peaks, np.diff(window_peaks))
+        band = (F > 0.04) & (F < 0.26)
+        frequencies.append(F[band][np.argmax(P[band])])
+        coherence.append(hrv_analyzer.coherence_ratio(F, P))
+    return np.array(frequencies), np.array(coherence)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HRV spectrum estimators benchmark")
+    parser.add_argument('--fs', type=int, default=500)
+    parser.add_argument('--seconds', type=int, default=600, help="Length of the tiled test_perun.raw and synthetic signals")
+    parser.add_argument('--missed', type=str, default='0,0.02,0.05', help="Fractions of missed beats, comma separated")
+    args = parser.parse_args()
+
+    peaks_time = detect_peaks(perun_ecg(args.seconds, args.fs), args.fs)
+    print(f"test_perun.raw, {len(peaks_time)} beats: calculate_hrv after every beat")
+    print(f"{'estimator':>9} {'p50 [us]':>9} {'p99 [us]':>9}")
+    for estimator in ESTIMATORS:
+        durations = live_cost(peaks_time, args.fs, estimator)
+        print(f"{estimator:>9} {np.percentile(durations, 50):>9.0f} {np.percentile(durations, 99):>9.0f}")
+
+    frequencies = {estimator: spectra(peaks_time, args.fs, estimator)[0] for estimator in ESTIMATORS}
+    print(f"peak frequency difference between the estimators: median {np.median(np.abs(frequencies['fft'] - frequencies['lomb'])):.4f} Hz")
+
+    print(f"\nsynthetic ECG, RR modulated at 0.1 Hz")
+    print(f"{'missed':>6} {'estimator':>9} {'peak error [Hz]':>16} {'coherence':>10}")
+    clean = detect_peaks(synthetic_ecg(args.seconds, args.fs), args.fs)
+    rng = np.random.default_rng(0)
+    for missed in (float(m) for m in args.missed.split(',')):
+        peaks = clean[np.concatenate(([True], rng.random(len(clean) - 1) >= missed))]
+        for estimator in ESTIMATORS:
+            frequencies, coherence = spectra(peaks, args.fs, estimator)
+            print(f"{missed:>6.2f} {estimator:>9} {np.median(np.abs(frequencies - 0.1)):>16.4f} {np.median(coherence):>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Replay of test_perun.raw tiled to one hour through the memory-mapped offline reader,
+compared with the previous whole-file reader."""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import test_signal as ts
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def legacy_test_signal(s_path, n_ch, dtype, channel, channel_base, chunk_size):
+    """The previous reader: whole file loaded, scaled copy, re-referencing of the whole array per chunk."""
+    s = np.fromfile(s_path, dtype=dtype)
+    s = s * 0.0715
+    if n_ch != 1:
+        s = np.reshape(s, (len(s)//n_ch, n_ch))
+    for i in range(0, len(s[:]), chunk_size):
+        if channel_base == -1:
+            syg = s if channel == 0 else s[:, channel]
+        else:
+            syg = s[:, channel] - s[:, channel_base]
+        yield syg[i:i+chunk_size]
+
+
+def write_tiled_recording(path, seconds, fs, n_ch):
+    # test_perun.raw repeated to the requested length, copied to every channel with a per-channel offset
+    source = np.fromfile(os.path.join(ROOT, 'test_perun.raw'), dtype='<f')
+    n_samples = int(seconds * fs)
+    block = np.repeat(source[:, np.newaxis], n_ch, axis=1) + np.arange(n_ch, dtype='<f')
+    with open(path, 'wb') as f:
+        written = 0
+        while written < n_samples:
+            part = block[:n_samples - written]
+            part.tofile(f)
+            written += len(part)
+
+
+def replay(generator, max_chunks=None):
+    tracemalloc.start()
+    start = time.perf_counter()
+    chunks = 0
+    for chunk in generator:
+        chunks += 1
+        if max_chunks is not None and chunks >= max_chunks:
+            break
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return chunks, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline reader benchmark")
+    parser.add_argument('--seconds', type=float, default=3600)
+    parser.add_argument('--Fs', type=int, default=500)
+    parser.add_argument('--n_ch', type=int, default=8)
+    parser.add_argument('--chunk_size', type=int, default=16)
+    parser.add_argument('--legacy_chunks', type=int, default=200, help="Chunks replayed with the previous reader (extrapolated)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tiled.raw')
+        write_tiled_recording(path, args.seconds, args.Fs, args.n_ch)
+        size_mb = os.path.getsize(path) / 2**20
+        total_chunks = -(-int(args.seconds * args.Fs) // args.chunk_size)
+        print(f"Recording: {args.seconds:.0f} s, {args.n_ch} channels at {args.Fs} Hz, {size_mb:.1f} MB, {total_chunks} chunks")
+
+        generator = ts.test_signal(path, n_ch=args.n_ch, channel=0, channel_base=1, fs=args.Fs,
+                                   chunk_size=args.chunk_size, realtime=False)
+        chunks, elapsed, peak = replay(generator)
+        print(f"memmap reader: {elapsed:8.2f} s total, {elapsed / chunks * 1e6:8.2f} us/chunk, "
+              f"peak allocations {peak / 2**20:8.2f} MB")
+
+        generator = legacy_test_signal(path, args.n_ch, '<f', 0, 1, args.chunk_size)
+        chunks, elapsed, peak = replay(generator, args.legacy_chunks)
+        print(f"legacy reader: {elapsed / chunks * total_chunks:8.2f} s total (extrapolated from {chunks} chunks), "
+              f"{elapsed / chunks * 1e6:8.2f} us/chunk, peak allocations {peak / 2**20:8.2f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""EKG figure payload per chart update: samples as JSON numbers (the previous builder) vs. binary typed arrays
+with all the samples vs. binary typed arrays min/max downsampled to the chart points setting, for a full
+buffer at several sampling rates."""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import plotly.graph_objs as go
+from plotly.io.json import to_json_plotly
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import EKGapp
+from suite import perun_ecg
+
+
+def json_figure(data_buffer, time_buffer, peaks):
+    """The previous builder: the signal trace with the samples as JSON numbers."""
+    figure = EKGapp.ekg_figure(data_buffer, time_buffer, peaks)
+    figure['data'][0] = go.Scatter(x=time_buffer, y=data_buffer, mode='lines', name='EKG Signal')
+    return figure
+
+
+def bench(builder, repeat):
+    # Dash serialises the returned figure with the plotly JSON encoder
+    run = lambda: to_json_plotly(builder())
+    elapsed = min(timeit.repeat(run, number=10, repeat=repeat)) / 10
+    return elapsed, len(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EKG figure payload benchmark")
+    parser.add_argument('--fs', type=str, default='250,500,1000,2000', help="Sampling rates, comma separated")
+    parser.add_argument('--buffer_seconds', type=int, default=5)
+    parser.add_argument('--points', type=int, default=EKGapp.chart_settings['ekg']['points'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'fs':>5} {'json [KB]':>10} {'[ms]':>6} {'binary [KB]':>12} {'[ms]':>6} "
+          f"{f'{args.points} points [KB]':>18} {'[ms]':>6}")
+    for fs in (int(f) for f in args.fs.split(',')):
+        # A full buffer an hour into an LSL session, one peak per second
+        data = perun_ecg(args.buffer_seconds, fs)
+        time_data = 3600 + np.arange(len(data)) / fs
+        peaks = time_data[::fs]
+
+        results = [bench(lambda: json_figure(data, time_data, peaks), args.repeat),
+                   bench(lambda: EKGapp.ekg_figure(data, time_data, peaks, 0), args.repeat),
+                   bench(lambda: EKGapp.ekg_figure(data, time_data, peaks, args.points), args.repeat)]
+        (json_time, json_size), (binary_time, binary_size), (points_time, points_size) = results
+        print(f"{fs:>5} {json_size / 1024:>10.1f} {json_time * 1e3:>6.2f} {binary_size / 1024:>12.1f} {binary_time * 1e3:>6.2f} "
+              f"{points_size / 1024:>18.1f} {points_time * 1e3:>6.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""EKG figure build and serialisation cost: one layout shape per peak vs. a single peak markers trace."""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import plotly.graph_objs as go
+from plotly.io.json import to_json_plotly
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import EKGapp
+
+
+def shapes_figure(data_buffer, time_buffer, peaks):
+    """The previous builder: every detected peak becomes a layout shape, visible or not."""
+    ekg_trace = go.Scatter(x=time_buffer, y=data_buffer, mode='lines', name='EKG Signal')
+    shapes = [dict(type="line", x0=peak, y0=0, x1=peak, y1=2000, line=dict(color="red", width=3))
+              for peak in peaks]
+    return {
+        'data': [ekg_trace],
+        'layout': go.Layout(
+            title='Live EKG Data',
+            shapes=shapes,
+            plot_bgcolor='white',
+            paper_bgcolor='white',
+            xaxis=dict(gridcolor='white', linecolor='white', range=[time_buffer[0], time_buffer[-1]]),
+            yaxis=dict(gridcolor='lightgrey', linecolor='black', range=EKGapp.chart_settings['ekg']['range'])
+        )
+    }
+
+
+def bench(builder, data, time_data, peaks, repeat):
+    # Dash serialises the returned figure with the plotly JSON encoder
+    run = lambda: to_json_plotly(builder(data, time_data, peaks))
+    elapsed = min(timeit.repeat(run, number=20, repeat=repeat)) / 20
+    return elapsed, len(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak markers rendering benchmark")
+    parser.add_argument('--fs', type=int, default=500)
+    parser.add_argument('--buffer_seconds', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    n = args.fs * args.buffer_seconds
+    print(f"{'peaks':>6} {'shapes [ms]':>12} {'shapes [KB]':>12} {'trace [ms]':>11} {'trace [KB]':>11} {'speedup':>8}")
+    for n_peaks in (10, 40, 160):
+        # Peaks spread over the whole peak history (about 1 per second), the buffer shows the newest seconds
+        end = max(n_peaks, args.buffer_seconds) + 1.0
+        time_data = end - args.buffer_seconds + np.arange(1, n + 1) / args.fs
+        data = np.random.default_rng(0).standard_normal(n) * 100
+        peaks = np.linspace(end - n_peaks, end - 0.5, n_peaks)
+
+        shapes_time, shapes_size = bench(shapes_figure, data, time_data, peaks, args.repeat)
+        trace_time, trace_size = bench(EKGapp.ekg_figure, data, time_data, peaks, args.repeat)
+        print(f"{n_peaks:>6} {shapes_time * 1e3:>12.2f} {shapes_size / 1024:>12.1f} "
+              f"{trace_time * 1e3:>11.2f} {trace_size / 1024:>11.1f} {shapes_time / trace_time:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Startup cost of the headless pipeline vs. the pipeline with the browser app imported: import time,
+time to the first processed sample and peak resident memory, each measured in a fresh interpreter."""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CHILD = """
+import time
+start = time.perf_counter()
+import sys, json, resource
+sys.path.insert(0, {root!r})
+import EKGProcessor as ekgp
+import test_signal as ts
+{ui_import}
+imported = time.perf_counter()
+
+inlet = ts.test_signal({s_path!r}, n_ch=1, channel=0, channel_base=-1)
+processor = ekgp.SignalProcessor(inlet=inlet, mode='offline')
+peaks_detector = ekgp.PeaksDetector(processor)
+hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector)
+processor.start()
+processor.data_updated.wait(0, timeout=10)
+first_sample = time.perf_counter()
+processor.stop()
+
+print(json.dumps({{'import': imported - start, 'first_sample': first_sample - start,
+                  'modules': len(sys.modules), 'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}))
+"""
+
+VARIANTS = {
+    'headless': 'import headless',
+    'dashboard': 'import EKGapp',
+}
+
+
+def run(variant, s_path):
+    code = CHILD.format(root=ROOT, s_path=s_path, ui_import=VARIANTS[variant])
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless startup benchmark")
+    parser.add_argument('--s_path', type=str, default=os.path.join(ROOT, 'test_perun.raw'))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'':>10} {'import [ms]':>12} {'first sample [ms]':>18} {'modules':>8} {'max RSS [MB]':>13}")
+    for variant in VARIANTS:
+        # The fastest of a few runs, the first one may include cold disk caches
+        results = [run(variant, args.s_path) for _ in range(args.repeat)]
+        best = min(results, key=lambda r: r['first_sample'])
+        print(f"{variant:>10} {best['import'] * 1e3:>12.0f} {best['first_sample'] * 1e3:>18.0f} "
+              f"{best['modules']:>8} {best['maxrss'] / 1024:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Server load with many dashboard viewers, with and without the shared render cache. The signal is replayed
+in real time through the whole processing chain and the Dash app is served over HTTP, while the viewers, in a
+separate process, poll the four chart callbacks once per interval (each at its own phase) like a browser with
+its dcc.Interval. Reports the CPU use of the server process, the callback latency seen by the viewers and the
+number of figures built per second."""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from werkzeug.serving import make_server
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import EKGProcessor as ekgp
+import EKGapp
+import metrics
+from replay import ReplaySource
+
+GRAPHS = ('live-graph-ekg', 'live-graph-hr', 'live-graph-hrv', 'live-graph-coherence')
+
+
+def callback_bodies(app):
+    dependencies = app.server.test_client().get('/_dash-dependencies').json
+    values = {'interval-component.n_intervals': 1, 'running-state.data': True, 'show-peaks-toggle.value': ['show_peaks']}
+    spec = lambda x: {'id': x['id'], 'property': x['property'], 'value': values.get(x['id'] + '.' + x['property'])}
+    bodies = []
+    for graph in GRAPHS:
+        dependency = [d for d in dependencies if d['output'] == graph + '.figure'][0]
+        bodies.append({'output': dependency['output'], 'outputs': {'id': graph, 'property': 'figure'},
+                       'inputs': [spec(x) for x in dependency['inputs']], 'state': [spec(x) for x in dependency['state']],
+                       'changedPropIds': ['interval-component.n_intervals']})
+    return bodies
+
+
+def viewer(url, bodies, interval, seconds, durations):
+    time.sleep(random.uniform(0, interval))
+    next_time = time.perf_counter()
+    end = next_time + seconds
+    while next_time < end:
+        for body in bodies:
+            request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            durations.append(time.perf_counter() - start)
+        next_time += interval
+        time.sleep(max(next_time - time.perf_counter(), 0))
+
+
+def viewers_process(url, bodies, n_viewers, interval, seconds, results):
+    # All the viewers of one measurement, in their own process so their CPU use is not counted for the server
+    durations = []
+    threads = [threading.Thread(target=viewer, args=(url, bodies, interval, seconds, durations)) for _ in range(n_viewers)]
+    results.put('started')
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(durations)
+
+
+def figures_built():
+    return sum(child.value for values, child in metrics.RENDER_CACHE.children.items() if values[1] == 'miss')
+
+
+def bench(app, cached, n_viewers, interval, seconds):
+    server = make_server('127.0.0.1', 0, app.server, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    url = f'http://127.0.0.1:{server.server_port}/_dash-update-component'
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=viewers_process, args=(url, callback_bodies(app), n_viewers, interval, seconds, results))
+    process.start()
+    # The measurement starts once the viewers process is up and running and lasts as long as the viewers
+    results.get()
+    built = figures_built()
+    cpu = time.process_time()
+    time.sleep(seconds + interval)
+    cpu = (time.process_time() - cpu) / (seconds + interval) * 100
+    builds = figures_built() - built
+    durations = results.get()
+    process.join()
+    server.shutdown()
+    server_thread.join()
+
+    durations = np.array(durations) * 1e3 if durations else np.zeros(1)
+    builds = builds / (seconds + interval) if cached else len(durations) / seconds
+    return cpu, np.percentile(durations, 50), np.percentile(durations, 99), builds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Many dashboard viewers benchmark")
+    parser.add_argument('--s_path', type=str, default=os.path.join(ROOT, 'test_perun.raw'))
+    parser.add_argument('--viewers', type=str, default='0,1,4,16')
+    parser.add_argument('--interval', type=float, default=1.0, help="Chart refresh interval of every viewer in seconds")
+    parser.add_argument('--seconds', type=float, default=6)
+    parser.add_argument('--warmup', type=float, default=15, help="Signal played before the measurements, for the HRV results")
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    processor = ekgp.SignalProcessor(inlet=ReplaySource(args.s_path), mode='offline')
+    peaks_detector = ekgp.PeaksDetector(processor)
+    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector)
+    apps = {cached: EKGapp.run_dash_app(processor, peaks_detector, hrv_analyzer, int(args.interval * 1000), render_cache=cached)
+            for cached in (False, True)}
+    processor.start()
+    peaks_detector.start()
+    hrv_analyzer.start()
+    time.sleep(args.warmup)
+
+    print(f"{'viewers':>7} {'cache':>6} {'CPU [%]':>8} {'callback p50 [ms]':>18} {'p99 [ms]':>9} {'figures built/s':>16}")
+    try:
+        for n_viewers in (int(n) for n in args.viewers.split(',')):
+            for cached in (False, True):
+                cpu, p50, p99, builds = bench(apps[cached], cached, n_viewers, args.interval, args.seconds)
+                print(f"{n_viewers:>7} {'on' if cached else 'off':>6} {cpu:>8.1f} {p50:>18.2f} {p99:>9.2f} {builds:>16.1f}")
+    finally:
+        processor.stop()
+        peaks_detector.stop()
+        hrv_analyzer.stop()
+
+
+if __name__ == '__main__':
+    main()
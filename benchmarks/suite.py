@@ -0,0 +1,229 @@
+"""Benchmark suite for the processing hot paths.
+
+Every case of the parameter grid (signal x sampling rate x chunk size x buffer length x session length)
+streams a session through SignalProcessor.add_data chunk by chunk, runs PeaksDetector.update_peaks,
+HRVAnalyzer.calculate_hrv and calculate_coherence once per simulated second like the polling threads,
+and finally calls the Dash figure callbacks with full buffers. Per-call latency statistics and
+throughput are written to a JSON file; --compare prints the ratios against a previous results file.
+
+    python benchmarks/suite.py --output results_new.json --compare results_old.json
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import scipy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import EKGProcessor as ekgp
+import test_signal as ts
+
+
+def perun_ecg(seconds, fs):
+    """test_perun.raw resampled to `fs` and tiled to the session length."""
+    s = np.concatenate(list(ts.test_signal(os.path.join(ROOT, 'test_perun.raw'), channel=0, channel_base=-1,
+                                           chunk_size=50000, realtime=False)))
+    t = np.arange(int(len(s) * fs / 500)) / fs
+    s = np.interp(t, np.arange(len(s)) / 500, s)
+    return np.tile(s, int(np.ceil(seconds * fs / len(s))))[:int(seconds * fs)]
+
+
+def synthetic_ecg(seconds, fs, seed=0):
+    """ECG-like signal in uV: Gaussian P-QRS-T waves at RR intervals modulated at 0.1 Hz (the coherent
+    breathing rhythm), with baseline wander, 50 Hz mains interference and white noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * fs)) / fs
+    beats = [0.5]
+    while beats[-1] < seconds:
+        beats.append(beats[-1] + 0.9 + 0.08 * np.sin(2 * np.pi * 0.1 * beats[-1]) + rng.normal(0, 0.01))
+    waves = ((150, -0.2, 0.025), (-100, -0.03, 0.01), (1500, 0, 0.012), (-300, 0.03, 0.01), (350, 0.25, 0.05))
+    x = np.zeros_like(t)
+    for beat in beats:
+        window = slice(max(int((beat - 0.4) * fs), 0), int((beat + 0.5) * fs))
+        for amplitude, offset, width in waves:
+            x[window] += amplitude * np.exp(-((t[window] - beat - offset) ** 2) / (2 * width ** 2))
+    x += 200 * np.sin(2 * np.pi * 0.3 * t) + 50 * np.sin(2 * np.pi * 50 * t) + rng.normal(0, 20, len(t))
+    return x
+
+
+SIGNALS = {'perun': perun_ecg, 'synthetic': synthetic_ecg}
+
+
+def stats(durations, samples=None):
+    """Latency statistics in microseconds; throughput in samples per second when `samples` is given."""
+    d = np.asarray(durations, dtype=np.float64) * 1e6
+    result = {'calls': len(d)}
+    if len(d):
+        result.update({'mean_us': float(np.mean(d)), 'p50_us': float(np.percentile(d, 50)),
+                       'p95_us': float(np.percentile(d, 95)), 'p99_us': float(np.percentile(d, 99)),
+                       'max_us': float(np.max(d))})
+        if samples is not None:
+            result['samples_per_s'] = samples / (np.sum(d) * 1e-6)
+    return result
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def dash_callbacks(processor, peaks_detector, hrv_analyzer, repeat):
+    """Full-figure chart callbacks called through the Dash request handler, including serialisation.
+    The render cache is off, so every call builds its figure."""
+    import EKGapp
+    app = EKGapp.run_dash_app(processor, peaks_detector, hrv_analyzer, 1000, render_cache=False)
+    client = app.server.test_client()
+    dependencies = client.get('/_dash-dependencies').json
+    values = {'interval-component.n_intervals': 1, 'running-state.data': True, 'show-peaks-toggle.value': ['show_peaks']}
+
+    results = {}
+    for graph in ('live-graph-ekg', 'live-graph-hr', 'live-graph-hrv', 'live-graph-coherence'):
+        dependency = [d for d in dependencies if d['output'] == graph + '.figure'][0]
+        spec = lambda x: {'id': x['id'], 'property': x['property'], 'value': values.get(x['id'] + '.' + x['property'])}
+        body = {'output': dependency['output'], 'outputs': {'id': graph, 'property': 'figure'},
+                'inputs': [spec(x) for x in dependency['inputs']], 'state': [spec(x) for x in dependency['state']],
+                'changedPropIds': ['interval-component.n_intervals']}
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.post('/_dash-update-component', json=body)
+            durations.append(time.perf_counter() - start)
+        results['callback_' + graph.replace('live-graph-', '')] = dict(stats(durations), payload_bytes=len(response.data))
+    return results
+
+
+def run_case(signal_name, fs, chunk_size, buffer_seconds, session_seconds, with_dash, dash_repeat):
+    x = SIGNALS[signal_name](session_seconds, fs)
+    chunks = [x[i:i + chunk_size] for i in range(0, len(x), chunk_size)]
+
+    # The filter alone, on its own processor so its state does not affect the pipeline run
+    filter_processor = ekgp.SignalProcessor(inlet=None, samps_per_chunk=chunk_size, sampling_rate=fs,
+                                            buffor_size_seconds=buffer_seconds, mode='offline')
+    filter_times = [timed(filter_processor.filter_data, chunk) for chunk in chunks]
+
+    processor = ekgp.SignalProcessor(inlet=None, samps_per_chunk=chunk_size, sampling_rate=fs,
+                                     buffor_size_seconds=buffer_seconds, mode='offline')
+    peaks_detector = ekgp.PeaksDetector(processor)
+    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector)
+
+    add_times, peaks_times, hrv_times, coherence_times = [], [], [], []
+    next_second = fs
+    for chunk in chunks:
+        add_times.append(timed(processor.add_data, chunk))
+        if processor.sample_count >= next_second:
+            next_second += fs
+            peaks_times.append(timed(peaks_detector.update_peaks))
+            with peaks_detector.peaks_lock:
+                rr_intervals = list(peaks_detector.rr_intervals)[-5:]
+            peaks_detector.calculate_bpm(rr_intervals)
+            if len(peaks_detector.rr_intervals) >= 10:
+                hrv_times.append(timed(hrv_analyzer.calculate_hrv))
+                coherence_times.append(timed(hrv_analyzer.calculate_coherence))
+
+    metrics = {
+        'filter_data': stats(filter_times, len(x)),
+        'add_data': stats(add_times, len(x)),
+        'update_peaks': stats(peaks_times),
+        'calculate_hrv': stats(hrv_times),
+        'calculate_coherence': stats(coherence_times),
+    }
+    if with_dash:
+        metrics.update(dash_callbacks(processor, peaks_detector, hrv_analyzer, dash_repeat))
+
+    return {
+        'params': {'signal': signal_name, 'fs': fs, 'chunk_size': chunk_size,
+                   'buffer_seconds': buffer_seconds, 'session_seconds': session_seconds},
+        'peaks_found': len(peaks_detector.peaks_time),
+        'metrics': metrics,
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+
+def case_key(case):
+    p = case['params']
+    return (p['signal'], p['fs'], p['chunk_size'], p['buffer_seconds'], p['session_seconds'])
+
+
+def compare(results, baseline_path, statistic, threshold):
+    """Prints the ratio of `statistic` (current / baseline) for every case and metric present in both files."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    base_cases = {case_key(case): case for case in baseline['cases']}
+    print(f"\nCompared with {baseline_path} (commit {baseline['environment'].get('commit')}), {statistic} ratio, "
+          f"regressions above {threshold:.2f}x marked with !")
+    regressions = 0
+    for case in results['cases']:
+        base = base_cases.get(case_key(case))
+        if base is None:
+            continue
+        ratios = []
+        for metric, values in case['metrics'].items():
+            base_value = base['metrics'].get(metric, {}).get(statistic)
+            if values.get(statistic) is None or not base_value:
+                continue
+            ratio = values[statistic] / base_value
+            flag = '!' if ratio > threshold else ' '
+            regressions += ratio > threshold
+            ratios.append(f"{metric} {ratio:.2f}x{flag}")
+        print('/'.join(str(v) for v in case_key(case)) + ': ' + ', '.join(ratios))
+    print(f"{regressions} regression(s)")
+
+
+def int_list(text):
+    return [int(v) for v in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Processing hot paths benchmark suite")
+    parser.add_argument('--signals', type=str, default='perun,synthetic')
+    parser.add_argument('--fs', type=int_list, default=[500, 1000], help="Sampling rates, comma separated")
+    parser.add_argument('--chunk_sizes', type=int_list, default=[16, 64])
+    parser.add_argument('--buffer_seconds', type=int_list, default=[5, 20])
+    parser.add_argument('--session_seconds', type=int_list, default=[120])
+    parser.add_argument('--no_dash', action='store_true', help="Skip the Dash callbacks")
+    parser.add_argument('--dash_repeat', type=int, default=20)
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--compare', type=str, default=None, help="Previous results file to compare with")
+    parser.add_argument('--statistic', type=str, default='p50_us', help="Statistic used by --compare")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Ratio reported as a regression by --compare")
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'cases': []}
+    grid = itertools.product(args.signals.split(','), args.fs, args.chunk_sizes, args.buffer_seconds, args.session_seconds)
+    for signal_name, fs, chunk_size, buffer_seconds, session_seconds in grid:
+        case = run_case(signal_name, fs, chunk_size, buffer_seconds, session_seconds, not args.no_dash, args.dash_repeat)
+        results['cases'].append(case)
+        m = case['metrics']
+        summary = ', '.join(f"{name} {m[name]['p50_us']:.1f} us" for name in m if 'p50_us' in m[name])
+        print(f"{signal_name} fs={fs} chunk={chunk_size} buffer={buffer_seconds}s session={session_seconds}s "
+              f"peaks={case['peaks_found']}: {summary}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare, args.statistic, args.threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,35 @@
-import plotly.express as px
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 
-def creating_ramp(hold_zero=15, inhale=10, hold_one=15, exhale=10, speed=-3, loops=10, info_from_user=False, text_above_dot=True):
+# Frame durations in milliseconds selected by `speed`. Examples, can be changed
+SPEEDRANGE = [100, 50, 25, 15, 10, 5]
 
-    # One segment
+# Number of intermediate frames to add between each main frame
+INTERPOLATION_FACTOR = 5
+
+def breathing_segment(hold_zero, inhale, hold_one, exhale):
+    """One segment of the breathing scheme and the command (text position, label) for each of its samples."""
     sig = np.concatenate((np.zeros(hold_zero // 2),
                           np.arange(0, 1, 1 / inhale),
                           np.ones(hold_one),
                           np.arange(1, 0, -1 / exhale),
                           np.zeros(hold_zero // 2)))
 
+    segment_time = hold_zero // 2 + inhale + hold_one + exhale + hold_zero // 2
+    phases = [(hold_zero // 2, 'top center', 'hold'),
+              (hold_zero // 2 + inhale, 'middle left', 'inhale'),
+              (hold_zero // 2 + inhale + hold_one, 'top center', 'hold'),
+              (hold_zero // 2 + inhale + hold_one + exhale, 'middle right', 'exhale'),
+              (segment_time, 'top center', 'hold')]
+    instructions = [next((p[1:] for p in phases if n % segment_time < p[0]), phases[-1][1:]) for n in range(len(sig))]
+    return sig, instructions
+
+def creating_ramp(hold_zero=15, inhale=10, hold_one=15, exhale=10, speed=-3, loops=10, info_from_user=False, text_above_dot=True):
+
+    # One segment
+    sig, instructions = breathing_segment(hold_zero, inhale, hold_one, exhale)
+
     # Just visual, the length can be changed
     scheme = np.tile(sig, 3)
     loop_time = len(sig)
@@ -28,32 +46,14 @@ def creating_ramp(hold_zero=15, inhale=10, hold_one=15, exhale=10, speed=-3, loo
     else:
         mode_pick = "markers"
 
-    # Command text visuals
-    def instruct(n):
-        segment_time = hold_zero//2 + inhale + hold_one + exhale + hold_zero//2
-        pos = n % segment_time
-        if pos < hold_zero // 2:
-            return ['top center', 'hold']
-        elif pos < hold_zero // 2 + inhale:
-            return ['middle left', 'inhale']
-        elif pos < hold_zero // 2 + inhale + hold_one:
-            return ['top center', 'hold']
-        elif pos < hold_zero // 2 + inhale + hold_one + exhale:
-            return ['middle right', 'exhale']
-        else:
-            return ['top center', 'hold']
-
-    # Examples, can be changed
-    speedrange = [100, 50, 25, 15, 10, 5]
-
     # Interpolate additional frames for smooth animation
-    interpolation_factor = 5  # Number of intermediate frames to add between each main frame
+    interpolation_factor = INTERPOLATION_FACTOR
     extended_scheme = np.interp(np.arange(0, total_time, 1 / interpolation_factor), np.arange(0, total_time), scheme)
 
     # Create frames for animation
     frames = [go.Frame(data=[go.Scatter(x=[(i / interpolation_factor) % total_time], y=[n], mode=mode_pick,
-                                        textposition=instruct(int(i / interpolation_factor) % loop_time)[0],
-                                        texttemplate=instruct(int(i / interpolation_factor) % loop_time)[1])])
+                                        textposition=instructions[int(i / interpolation_factor) % loop_time][0],
+                                        texttemplate=instructions[int(i / interpolation_factor) % loop_time][1])])
               for i, n in enumerate(np.tile(extended_scheme,3))]
 
 
@@ -70,7 +70,7 @@ def creating_ramp(hold_zero=15, inhale=10, hold_one=15, exhale=10, speed=-3, loo
                     buttons=list([
                         dict(label="start",
                              method="animate",
-                             args=[None, {"frame": {"duration": speedrange[speed],
+                             args=[None, {"frame": {"duration": SPEEDRANGE[speed],
                                                     "redraw": True},
                                           "fromcurrent": True,
                                           "mode": "immediate",
@@ -98,6 +98,62 @@ def creating_ramp(hold_zero=15, inhale=10, hold_one=15, exhale=10, speed=-3, loo
     fig.update_traces(marker=dict(size=20, symbol='circle', color=["#6699CC"]))
     return fig
 
+# Browser-side step of the pacer used in the dashboard: moves the dot (trace 0) to animation frame n
+# through extendData, so the figure only has to hold the scheme and the per-sample instructions
+PACER_STEP_JS = """
+function(n, pacer) {
+    if (!pacer || n >= pacer.frames) {
+        return window.dash_clientside.no_update;
+    }
+    const steps = pacer.scheme.length * pacer.factor;
+    const x = (n % steps) / pacer.factor;
+    const k = Math.floor(x);
+    const next = Math.min(k + 1, pacer.scheme.length - 1);
+    const y = pacer.scheme[k] + (pacer.scheme[next] - pacer.scheme[k]) * (x - k);
+    const pos = k % pacer.labels.length;
+    return [{x: [[x]], y: [[y]], text: [[pacer.labels[pos]]], textposition: [[pacer.positions[pos]]]}, [0], 1];
+}
+"""
+
+def creating_pacer(hold_zero=15, inhale=10, hold_one=15, exhale=10, speed=-3, loops=10, info_from_user=False, text_above_dot=True):
+    """The same breathing scheme as creating_ramp, without the animation frames. Returns the figure,
+    the parameters for PACER_STEP_JS and the frame duration in milliseconds."""
+
+    # One segment and the command shown above the dot for every sample of it
+    sig, instructions = breathing_segment(hold_zero, inhale, hold_one, exhale)
+    scheme = np.tile(sig, 3)
+    loop_time = len(sig)
+    total_time = len(scheme)
+
+    interpolation_factor = INTERPOLATION_FACTOR
+    pacer = {
+        'scheme': scheme.tolist(),
+        'positions': [position for position, _ in instructions],
+        'labels': [label if text_above_dot else '' for _, label in instructions],
+        'factor': interpolation_factor,
+        'frames': loops * loop_time * interpolation_factor,
+    }
+
+    fig = go.Figure(
+        data=[go.Scatter(x=[0], y=[scheme[0]], mode="markers+text" if text_above_dot else "markers",
+                         text=[pacer['labels'][0]], textposition=[pacer['positions'][0]]),
+              go.Scatter(x=np.arange(total_time), y=scheme, mode='lines', line_color='#003366')],
+        layout=go.Layout(
+            xaxis=dict(range=[0, total_time], autorange=False),
+            yaxis=dict(range=[-0.25, 1.25], autorange=False),
+            title=" -- Breathing Scheme --",
+        )
+    )
+
+    fig.update_xaxes(showticklabels=False, showgrid=False, zeroline=False)
+    fig.update_yaxes(showticklabels=False, showgrid=False, zeroline=False)
+    fig.update_layout(showlegend=False,
+                      template='presentation',
+                      font_family="Courier New",
+                      font_color="#003399")
+    fig.update_traces(marker=dict(size=20, symbol='circle', color=["#6699CC"]))
+    return fig, pacer, SPEEDRANGE[speed]
+
 if __name__ == '__main__':
     scheme = creating_ramp()
     scheme.show()
@@ -0,0 +1,26 @@
+from scipy import signal
+import numpy as np
+
+try:
+    # Compiled kernel behind signal.sosfilt; calling it directly skips the argument
+    # validation that dominates the cost of filtering a 16-sample chunk.
+    from scipy.signal._sosfilt import _sosfilt
+except ImportError:
+    _sosfilt = None
+
+def sosfilt_state(sos, n_signals=1):
+    """Initial state for `sosfilt_chunk`, one (n_sections, 2) block per filtered signal."""
+    return np.repeat(signal.sosfilt_zi(sos)[np.newaxis], n_signals, axis=0)
+
+def sosfilt_chunk(sos, x, zi):
+    """Filters a chunk along its first axis, the columns of a 2-D chunk being separate signals.
+    The state `zi` of shape (n_signals, n_sections, 2) is updated in place."""
+    # The kernel filters rows of a C-contiguous float64 array in place. It does not check the shapes,
+    # so anything unexpected goes through signal.sosfilt, which raises a ValueError instead
+    rows = np.array(np.asarray(x).T, dtype=np.float64, order='C', ndmin=2)
+    if _sosfilt is None or zi.shape != (rows.shape[0], len(sos), 2) or np.shape(sos)[1:] != (6,):
+        rows, zf = signal.sosfilt(sos, rows, axis=-1, zi=zi.transpose(1, 0, 2))
+        zi[...] = zf.transpose(1, 0, 2)
+    else:
+        _sosfilt(sos, rows, zi)
+    return rows[0] if np.ndim(x) == 1 else rows.T
@@ -0,0 +1,64 @@
+import json
+import sys
+from collections import deque
+
+class HeadlessReporter:
+    """Runs the SignalProcessor -> PeaksDetector -> HRVAnalyzer chain without the browser app and writes
+    one JSON line per detected R-peak: its time, the RR interval ending at it, the current BPM and coherence.
+    The peaks are taken from a PeaksDetector listener registered before the processing starts, so none is
+    missed however fast the signal arrives."""
+
+    def __init__(self, signal_processor, peaks_detector, hrv_analyzer, output=None):
+        self.signal_processor = signal_processor
+        self.peaks_detector = peaks_detector
+        self.hrv_analyzer = hrv_analyzer
+        self.output = output
+        self.pending = deque() # (peaks, rr_intervals) batches from the PeaksDetector, not written yet
+
+    def add_peaks(self, peaks, prominences, rr_intervals):
+        self.pending.append((peaks, rr_intervals))
+
+    def report(self, out):
+        if not self.pending:
+            return
+
+        bpm = self.peaks_detector.get_bpm()
+        bpm = float(bpm[-1]) if bpm.size else None
+        coherence = self.hrv_analyzer.get_coherence_value()
+        coherence = float(coherence) if coherence is not None else None
+
+        while self.pending:
+            peaks, rr_intervals = self.pending.popleft()
+            # The first peak of a session has no RR interval, the others the one ending at them
+            first_rr = len(peaks) - len(rr_intervals)
+            for i, peak in enumerate(peaks):
+                rr = round(float(rr_intervals[i - first_rr]), 4) if i >= first_rr else None
+                out.write(json.dumps({'time': round(float(peak), 4), 'rr': rr, 'bpm': bpm, 'coherence': coherence}) + '\n')
+        out.flush()
+
+    def run(self):
+        """Processes the signal until the end of the recording or Ctrl+C."""
+        out = sys.stdout if self.output is None else open(self.output, 'w')
+        # The listeners are in place before the first chunk is filtered
+        self.peaks_detector.add_peak_listener(self.add_peaks)
+        self.peaks_detector.start()
+        self.hrv_analyzer.start()
+        self.signal_processor.start()
+        try:
+            peaks_version = self.peaks_detector.peaks_updated.version
+            while self.signal_processor.running:
+                peaks_version = self.peaks_detector.peaks_updated.wait(peaks_version)
+                self.report(out)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.signal_processor.stop()
+            self.peaks_detector.stop()
+            self.hrv_analyzer.stop()
+            self.peaks_detector.remove_peak_listener(self.add_peaks)
+            self.report(out)
+            if out is not sys.stdout:
+                out.close()
+
+def run_headless(signal_processor, peaks_detector, hrv_analyzer, output=None):
+    HeadlessReporter(signal_processor, peaks_detector, hrv_analyzer, output).run()
@@ -0,0 +1,115 @@
+import math
+import threading
+import numpy as np
+from ring_buffer import RingBuffer
+
+FIELDS = ('bpm', 'rmssd', 'coherence')
+
+class AggregateTier:
+    """Mean, minimum and maximum of every field over consecutive buckets of `seconds` seconds, the newest
+    `capacity` buckets kept in a ring buffer of rows (bucket start time, then mean, min, max of each field).
+    The open bucket is accumulated in running sums and written out when a sample of a later bucket arrives."""
+
+    def __init__(self, seconds, capacity):
+        self.seconds = seconds
+        self.rows = RingBuffer(capacity, channels=1 + 3 * len(FIELDS))
+        self.bucket = None
+        self.reset_bucket()
+
+    def reset_bucket(self):
+        self.sums = [0.0] * len(FIELDS)
+        self.counts = [0] * len(FIELDS)
+        self.minimums = [math.inf] * len(FIELDS)
+        self.maximums = [-math.inf] * len(FIELDS)
+
+    def add(self, time, values):
+        # Samples older than the open bucket (e.g. a coherence value computed for an earlier beat) are
+        # counted in the open bucket
+        bucket = math.floor(time / self.seconds)
+        if self.bucket is None:
+            self.bucket = bucket
+        elif bucket > self.bucket:
+            self.rows.extend(self.open_row()[None])
+            self.reset_bucket()
+            self.bucket = bucket
+
+        for i, value in enumerate(values):
+            if value is None or value != value:
+                continue
+            self.sums[i] += value
+            self.counts[i] += 1
+            self.minimums[i] = min(self.minimums[i], value)
+            self.maximums[i] = max(self.maximums[i], value)
+
+    def open_row(self):
+        row = [self.bucket * self.seconds]
+        for i in range(len(FIELDS)):
+            if self.counts[i]:
+                row += [self.sums[i] / self.counts[i], self.minimums[i], self.maximums[i]]
+            else:
+                row += [np.nan] * 3
+        return np.array(row)
+
+    def snapshot(self):
+        """All the stored rows and the open bucket."""
+        if self.bucket is None:
+            return self.rows.snapshot()
+        return np.concatenate((self.rows.snapshot(), self.open_row()[None]))
+
+    def complete(self):
+        """True while no bucket has been overwritten."""
+        return self.rows.written <= self.rows.capacity
+
+    def clear(self):
+        self.rows.clear()
+        self.bucket = None
+        self.reset_bucket()
+
+class SessionHistory:
+    """Bounded-memory history of a session for charts covering hours: every sample (BPM and RMSSD after each
+    beat, coherence after each spectrum) for the last `raw_seconds`, and per-second and per-minute mean,
+    minimum and maximum for the last `second_hours` and `minute_hours`. Memory is allocated up front and a
+    sample is added in O(1)."""
+
+    def __init__(self, raw_seconds=600, second_hours=6, minute_hours=168, max_bpm=240):
+        self.raw_seconds = raw_seconds
+        self.raw = RingBuffer(int(raw_seconds * max_bpm / 60), channels=1 + len(FIELDS))
+        self.tiers = [AggregateTier(1, int(second_hours * 3600)), AggregateTier(60, int(minute_hours * 60))]
+        self.start_time = None
+        self.version = 0 # incremented with every sample
+        self.lock = threading.Lock()
+
+    def add(self, time, bpm=None, rmssd=None, coherence=None):
+        values = (bpm, rmssd, coherence)
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time
+            self.raw.extend([[time] + [np.nan if value is None else value for value in values]])
+            for tier in self.tiers:
+                tier.add(time, values)
+            self.version += 1
+
+    def get(self, max_points=2000):
+        """Session start time, sample times and (mean, min, max) of every field, NaN where a row has no value
+        of the field, from the finest tier holding the whole session in at most `max_points` rows, or from the
+        coarsest tier. Raw samples have mean = min = max."""
+        with self.lock:
+            start_time = self.start_time
+            if self.raw.written <= min(self.raw.capacity, max_points):
+                raw = self.raw.snapshot()
+                return start_time, raw[:, 0], {field: (raw[:, 1 + i],) * 3 for i, field in enumerate(FIELDS)}
+
+            for tier in self.tiers:
+                rows = tier.snapshot()
+                if tier.complete() and rows.shape[0] <= max_points:
+                    break
+        return start_time, rows[:, 0], {field: (rows[:, 1 + 3 * i], rows[:, 2 + 3 * i], rows[:, 3 + 3 * i])
+                                        for i, field in enumerate(FIELDS)}
+
+    def clear(self):
+        with self.lock:
+            self.raw.clear()
+            for tier in self.tiers:
+                tier.clear()
+            self.start_time = None
+            self.version += 1
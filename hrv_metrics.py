@@ -0,0 +1,89 @@
+from collections import deque
+import numpy as np
+
+class RollingWindow:
+    """Time-domain HRV of the RR intervals ending in the last `seconds` seconds. Beats are added and dropped
+    one at a time, updating running sums: the mean and the sum of squared deviations of the RR intervals
+    (Welford's algorithm, for the SDNN), the sum of squared successive differences (RMSSD), the count of
+    successive differences over 50 ms (pNN50) and the sum of the instantaneous heart rates (mean HR)."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.beats = deque() # (time, rr, difference from the previous rr or None)
+        self.clear()
+
+    def clear(self):
+        self.beats.clear()
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.hr_sum = 0.0
+        self.differences = 0
+        self.squared_differences = 0.0
+        self.nn50 = 0
+
+    # A successive difference is counted while both of its RR intervals are in the window, i.e. for every
+    # beat but the oldest one
+    def count_difference(self, difference, sign):
+        if difference is None:
+            return
+        self.differences += sign
+        self.squared_differences += sign * difference * difference
+        self.nn50 += sign * (abs(difference) > 0.05)
+
+    def add(self, time, rr, difference):
+        if self.beats:
+            self.count_difference(difference, 1)
+        self.beats.append((time, rr, difference))
+        delta = rr - self.mean
+        self.mean += delta / len(self.beats)
+        self.m2 += delta * (rr - self.mean)
+        self.hr_sum += 60.0 / rr
+
+        while self.beats[0][0] <= time - self.seconds:
+            self.remove_oldest()
+
+    def remove_oldest(self):
+        _, rr, _ = self.beats.popleft()
+        if not self.beats:
+            self.clear() # also drops the rounding errors accumulated in the sums
+            return
+        self.count_difference(self.beats[0][2], -1)
+        delta = rr - self.mean
+        self.mean -= delta / len(self.beats)
+        self.m2 -= delta * (rr - self.mean)
+        self.hr_sum -= 60.0 / rr
+
+    def values(self):
+        n = len(self.beats)
+        return {
+            'beats': n,
+            'sdnn': np.sqrt(max(self.m2, 0.0) / (n - 1)) * 1000 if n > 1 else None,
+            'rmssd': np.sqrt(self.squared_differences / self.differences) * 1000 if self.differences else None,
+            'pnn50': 100.0 * self.nn50 / self.differences if self.differences else None,
+            'mean_hr': self.hr_sum / n if n else None,
+        }
+
+class RollingHRV:
+    """SDNN and RMSSD (ms), pNN50 (%) and mean HR (BPM) over sliding windows of the last `windows` seconds,
+    each updated in O(1) per new RR interval."""
+
+    def __init__(self, windows=(30, 60, 300)):
+        self.windows = [RollingWindow(seconds) for seconds in windows]
+        self.last_rr = None
+
+    def extend(self, times, rr_intervals):
+        """Adds the RR intervals ending at `times` (the times of their second beats)."""
+        for time, rr in zip(times, rr_intervals):
+            difference = None if self.last_rr is None else rr - self.last_rr
+            self.last_rr = rr
+            for window in self.windows:
+                window.add(time, rr, difference)
+
+    def values(self):
+        """Metrics of every window by its length in seconds."""
+        return {window.seconds: window.values() for window in self.windows}
+
+    def clear(self):
+        self.last_rr = None
+        for window in self.windows:
+            window.clear()
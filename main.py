@@ -1,59 +1,172 @@
-import lsl_perun32 as lsl
 import EKGProcessor as ekgp
-import EKGapp as ekgapp
 import argparse
+import functools
 import test_signal as ts
 import json
 
-def run_online(chunk_size, Fs, channel, interval, **breathing_settings):
+def parse_channels(channels):
+    # "23,24,1-0" -> [23, 24, (1, 0)], a pair being a lead derived as channel minus reference channel
+    if channels is None:
+        return None
+    leads = []
+    for lead in channels.split(','):
+        if '-' in lead:
+            pos, neg = lead.split('-')
+            leads.append((int(pos), int(neg)))
+        else:
+            leads.append(int(lead))
+    return leads
+
+def inlet_lead(channel, channel_base):
+    # The lead selected by a file inlet, in the notation of parse_channels (None: all the channels)
+    if channel is None or channel_base == -1:
+        return channel
+    return (channel, channel_base)
+
+def create_chain(make_inlet, settings, detector, lead, pipeline, acquisition='thread', record=None, estimator='fft'):
+    # SignalProcessor, PeaksDetector and HRVAnalyzer. With acquisition='signal' the processor, and with 'peaks'
+    # also the detector, run in a separate process that creates its own inlet with make_inlet
+    process = None
+    if acquisition == 'thread':
+        processor = ekgp.SignalProcessor(inlet=make_inlet(), **settings)
+        peaks_detector = ekgp.PeaksDetector(processor, detector=detector, lead=lead, pipeline=pipeline)
+    else:
+        from acquisition import AcquisitionProcess
+        peaks_settings = {'detector': detector, 'lead': lead, 'pipeline': pipeline} if acquisition == 'peaks' else None
+        process = AcquisitionProcess(make_inlet, settings, peaks_settings, record)
+        processor = process.signal_processor
+        peaks_detector = process.peaks_detector
+        if peaks_detector is None:
+            peaks_detector = ekgp.PeaksDetector(processor, detector=detector, lead=lead, pipeline=pipeline)
+    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector, pipeline=pipeline, estimator=estimator)
+    return processor, peaks_detector, hrv_analyzer, process
+
+def run_chain(make_inlet, settings, detector, lead, pipeline, acquisition, estimator, interval, incremental, headless, output, record, **breathing_settings):
+    processor, peaks_detector, hrv_analyzer, process = create_chain(make_inlet, settings, detector, lead, pipeline, acquisition, record, estimator)
+    try:
+        # The acquisition process records the session itself
+        run_app(processor, peaks_detector, hrv_analyzer, interval, incremental, headless, output,
+                record if process is None else None, **breathing_settings)
+    finally:
+        if process is not None:
+            process.close()
+
+def run_app(processor, peaks_detector, hrv_analyzer, interval, incremental, headless, output, record=None, **breathing_settings):
+    # Samples and peaks are written to the HDF5 file whenever the processing is running
+    recorder = None
+    if record is not None:
+        from recorder import SessionRecorder
+        recorder = SessionRecorder(record, processor, peaks_detector)
+        recorder.start()
+
+    try:
+        # The UI modules (dash, plotly, pandas) are imported only when the browser app is used
+        if headless:
+            from headless import run_headless
+            run_headless(processor, peaks_detector, hrv_analyzer, output)
+        else:
+            import EKGapp as ekgapp
+            ekgapp.run_dash_app_thread(processor, peaks_detector, hrv_analyzer, interval, incremental, **breathing_settings)
+    finally:
+        if recorder is not None:
+            recorder.stop()
+            print(f"Session saved to {record}: {recorder.written_chunks} chunks written, {recorder.dropped_chunks} dropped")
+
+def run_online(chunk_size, Fs, channel, interval, detector, channels=None, lead=0, pipeline='polling', incremental=False, headless=False, output=None, record=None, acquisition='thread', estimator='fft', **breathing_settings):
     # Start the LSL stream
-    inlet = lsl.start_stream('stream_1')
+    import lsl_perun32 as lsl
+    make_inlet = functools.partial(lsl.start_stream, 'stream_1')
 
-    # Create the processor, peaks detector and HRV analyzer
-    processor = ekgp.SignalProcessor(inlet=inlet, samps_per_chunk=chunk_size, sampling_rate=Fs, buffor_size_seconds=5, mode='online', channel=channel)
-    peaks_detector =  ekgp.PeaksDetector(processor)
-    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector)
+    # Create the processor, peaks detector and HRV analyzer and run the application
+    settings = dict(samps_per_chunk=chunk_size, sampling_rate=Fs, buffor_size_seconds=5, mode='online', channel=channel, channels=channels)
+    run_chain(make_inlet, settings, detector, lead, pipeline, acquisition, estimator, interval, incremental, headless, output, record, **breathing_settings)
 
-    # Run the application
-    ekgapp.run_dash_app_thread(processor, peaks_detector, hrv_analyzer, interval, **breathing_settings)
+def run_offline(chunk_size, Fs, s_path, n_ch, channel, channel_base, interval, detector, channels=None, lead=0, pipeline='polling', incremental=False, headless=False, output=None, record=None, acquisition='thread', estimator='fft', **breathing_settings):
+    # Generate the test signal, with all the channels when the leads are selected by the processor
+    if channels is not None:
+        channel = None
+    make_inlet = functools.partial(ts.test_signal, s_path=s_path, n_ch=n_ch, dtype='<f', channel=channel, channel_base=channel_base, fs=Fs, chunk_size=chunk_size)
 
-def run_offline(chunk_size, Fs, s_path, n_ch, channel, channel_base, interval, **breathing_settings):
-    # Generate the test signal
-    inlet = ts.test_signal(s_path=s_path, n_ch=n_ch, dtype='<f', channel=channel, channel_base=channel_base, fs=Fs, chunk_size=chunk_size)
+    # Create the processor, peaks detector and HRV analyzer and run the application
+    settings = dict(samps_per_chunk=chunk_size, sampling_rate=Fs, buffor_size_seconds=5, mode='offline',
+                    channel=inlet_lead(channel, channel_base), channels=channels)
+    run_chain(make_inlet, settings, detector, lead, pipeline, acquisition, estimator, interval, incremental, headless, output, record, **breathing_settings)
+
+def run_replay(chunk_size, Fs, s_path, n_ch, channel, channel_base, interval, detector, channels=None, lead=0, pipeline='polling', incremental=False, headless=False, output=None, record=None, replay_speed=1.0, start_time=0.0, events=None, acquisition='thread', estimator='fft', **breathing_settings):
+    # Replay a .raw recording or an HDF5 session, starting at any time and at any speed
+    from replay import ReplaySource
+    if channels is not None:
+        channel = None
+    make_inlet = functools.partial(ReplaySource, s_path, fs=Fs, n_ch=n_ch, channel=channel, channel_base=channel_base,
+                                   chunk_size=chunk_size, speed=replay_speed, start=start_time, events=events)
+    inlet = make_inlet()
+    # Leads recorded in multi-channel mode are replayed as they are
+    if inlet.n_leads is not None and channels is None:
+        channels = list(range(inlet.n_leads))
+    # An HDF5 session is replayed as it was recorded, a .raw file as selected by the inlet
+    source_lead = None if inlet.file is not None else inlet_lead(channel, channel_base)
+    settings = dict(samps_per_chunk=chunk_size, sampling_rate=inlet.fs, buffor_size_seconds=5, mode='offline',
+                    channel=source_lead, channels=channels)
+    if acquisition == 'thread':
+        make_inlet = lambda: inlet
+    else:
+        # The acquisition process opens the file again, the seek controls are not available then
+        inlet.close()
 
-    # Create the processor, peaks detector and HRV analyzer
-    processor = ekgp.SignalProcessor(inlet=inlet, samps_per_chunk=chunk_size, sampling_rate=Fs, buffor_size_seconds=5, mode='offline')
-    peaks_detector = ekgp.PeaksDetector(processor)
-    hrv_analyzer = ekgp.HRVAnalyzer(peaks_detector)
+    # Create the processor, peaks detector and HRV analyzer and run the application
+    run_chain(make_inlet, settings, detector, lead, pipeline, acquisition, estimator, interval, incremental, headless, output, record, **breathing_settings)
 
-    # Run the application
-    ekgapp.run_dash_app_thread(processor, peaks_detector, hrv_analyzer, interval, **breathing_settings)
+def run_batch(Fs, s_path, n_ch, channel, channel_base, output, estimator='fft'):
+    # Analyse the whole recording as fast as possible and save the results
+    import batch
+    batch.run_batch(s_path=s_path, out_path=output, n_ch=n_ch, channel=channel, channel_base=channel_base, fs=Fs, estimator=estimator)
 
 def main():
     # Parse the arguments
     parser = argparse.ArgumentParser(description="EKG Processor Application")
 
-    parser.add_argument('--mode', choices=['online', 'offline'], required=True, help="Mode to run the application in")
+    parser.add_argument('--mode', choices=['online', 'offline', 'batch', 'replay'], required=True, help="Mode to run the application in")
     parser.add_argument('--chunk_size', type=int, default=16, help="Chunk size for signal processing")
     parser.add_argument('--Fs', type=int, default=500, help="Sampling frequency")
     parser.add_argument('--n_ch', type=int, default=1, help="Channel count")
     parser.add_argument('--channel', type=int, default=0, help="Channel number")
     parser.add_argument('--channel_base', type=int, default=-1, help="Base channel number")
+    parser.add_argument('--channels', type=str, default=None, help="Multi-channel mode: comma separated channels or derived leads, e.g. '23,24,1-0'")
+    parser.add_argument('--lead', type=str, default='0', help="Index of the lead used for peak detection in multi-channel mode, or 'auto' for the lead with the most prominent R-peaks")
     parser.add_argument('--s_path', type=str, default='test_perun.raw', help="Signal path for offline mode")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay speed relative to real time, 0 for as fast as possible")
+    parser.add_argument('--start_time', type=float, default=0.0, help="Replay start time in seconds")
+    parser.add_argument('--events', type=str, default=None, help="Comma separated times of the events to jump between during a replay")
+    parser.add_argument('--output', type=str, default=None, help="Results file for batch mode (batch_results.npz by default) or for --headless (stdout by default)")
     parser.add_argument('--interval', type=int, default=1000, help="Application update interval")
+    parser.add_argument('--headless', action='store_true', help="Run without the browser app and stream BPM, RR intervals and coherence as JSON lines")
+    parser.add_argument('--record', type=str, default=None, help="Record raw and filtered samples, peaks and RR intervals to this HDF5 file")
+    parser.add_argument('--incremental', action='store_true', help="Send only new samples to the charts (extendData) instead of whole figures")
+    parser.add_argument('--pipeline', choices=['polling', 'event'], default='polling', help="Analysis threads polling every second or woken up by new data")
+    parser.add_argument('--acquisition', choices=['thread', 'signal', 'peaks'], default='thread', help="Run the SignalProcessor ('signal') or the SignalProcessor and PeaksDetector ('peaks') in a separate process publishing the data through shared memory")
+    parser.add_argument('--hrv', choices=['fft', 'lomb'], default='fft', help="HRV spectrum: periodogram of the RR tachogram resampled at 1 Hz or Lomb-Scargle periodogram of the RR intervals at the beat times")
+    parser.add_argument('--detector', choices=['batch', 'streaming'], default='batch', help="R-peak detector: find_peaks over the buffer every second or streaming Pan-Tompkins")
     parser.add_argument('--breathing', type=str, default='{"hold_zero":15, "inhale":10, "hold_one":15, "exhale":10, "speed":-3, "loops":10}')
 
     args = parser.parse_args()
 
     breathing_settings = json.loads(args.breathing)
+    channels = parse_channels(args.channels)
+    lead = args.lead if args.lead == 'auto' else int(args.lead)
 
     # Run the application in the selected mode
     if args.mode == 'online':
-        run_online(args.chunk_size, args.Fs, args.channel, args.interval, **breathing_settings)
+        run_online(args.chunk_size, args.Fs, args.channel, args.interval, args.detector, channels, lead, args.pipeline, args.incremental, args.headless, args.output, args.record, args.acquisition, args.hrv, **breathing_settings)
     elif args.mode == 'offline':
-        run_offline(args.chunk_size, args.Fs, args.s_path, args.n_ch, args.channel, args.channel_base, args.interval, **breathing_settings)
+        run_offline(args.chunk_size, args.Fs, args.s_path, args.n_ch, args.channel, args.channel_base, args.interval, args.detector, channels, lead, args.pipeline, args.incremental, args.headless, args.output, args.record, args.acquisition, args.hrv, **breathing_settings)
+    elif args.mode == 'replay':
+        events = [float(t) for t in args.events.split(',')] if args.events else None
+        run_replay(args.chunk_size, args.Fs, args.s_path, args.n_ch, args.channel, args.channel_base, args.interval, args.detector, channels, lead, args.pipeline, args.incremental, args.headless, args.output, args.record,
+                   args.speed, args.start_time, events, args.acquisition, args.hrv, **breathing_settings)
+    elif args.mode == 'batch':
+        run_batch(args.Fs, args.s_path, args.n_ch, args.channel, args.channel_base, args.output or 'batch_results.npz', args.hrv)
     else:
-        print("Invalid mode selected. Use 'online' or 'offline'.")
+        print("Invalid mode selected. Use 'online', 'offline', 'batch' or 'replay'.")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
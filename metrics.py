@@ -0,0 +1,206 @@
+import bisect
+import threading
+import time
+
+# Latency buckets in seconds, from a filtered chunk (~5 us) to a slow polling loop
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    """Metric family with optional labels. With labels, labels(*values) returns the child that is updated."""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def samples(self):
+        lines = []
+        for values, child in list(self.children.items()):
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}'] + self.samples()
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set_function(self, function):
+        """The value is read from `function` on every scrape, for totals a component already keeps."""
+        self.function = function
+
+    def samples(self, name, labelnames, values):
+        value = self.value if self.function is None else self.function()
+        return [f'{name}{format_labels(labelnames, values)} {format_value(value)}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+class GaugeValue:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """The value is read from `function` on every scrape; a None result leaves the sample out."""
+        self.function = function
+
+    def samples(self, name, labelnames, values):
+        value = self.value if self.function is None else self.function()
+        if value is None:
+            return []
+        return [f'{name}{format_labels(labelnames, values)} {format_value(value)}']
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self, name, labelnames, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(labelnames, values, [("le", format_value(bound))])} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labelnames, values)} {format_value(total)}')
+        lines.append(f'{name}_count{format_labels(labelnames, values)} {cumulative}')
+        return lines
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+class Timer:
+    """Context manager observing the duration of its block in a histogram."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'ekg_stage_seconds', 'Processing time of one call of a pipeline stage.', ['stage']))
+LOCK_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'ekg_lock_wait_seconds', 'Time spent waiting for a lock.', ['lock']))
+LOOP_LAG_SECONDS = REGISTRY.register(Histogram(
+    'ekg_loop_lag_seconds', 'Delay between the due time of a processing thread iteration (the end of its sleep '
+    'or the publication of new data) and its start.', ['loop']))
+CALLBACK_SECONDS = REGISTRY.register(Histogram(
+    'ekg_callback_seconds', 'Dash callback request time, including serialisation, per callback output.', ['output']))
+CALLBACK_BYTES = REGISTRY.register(Counter(
+    'ekg_callback_response_bytes_total', 'Bytes sent in Dash callback responses.', ['output']))
+RENDER_CACHE = REGISTRY.register(Counter(
+    'ekg_render_cache_total', 'Chart figures served from the shared render cache (hit) or built (miss).', ['figure', 'result']))
+SAMPLES = REGISTRY.register(Counter(
+    'ekg_samples_total', 'Samples added to the signal buffers.'))
+CHUNKS = REGISTRY.register(Counter(
+    'ekg_chunks_total', 'Chunks added to the signal buffers.'))
+SNAPSHOT_RETRIES = REGISTRY.register(Counter(
+    'ekg_snapshot_retries_total', 'Buffer snapshots taken again because a chunk was written during the copy.'))
+PEAKS = REGISTRY.register(Counter(
+    'ekg_peaks_total', 'Detected R-peaks.'))
+SAMPLE_RATE = REGISTRY.register(Gauge(
+    'ekg_samples_per_second', 'Rate at which samples were added over the recent chunks.'))
+CHUNK_BACKLOG = REGISTRY.register(Gauge(
+    'ekg_chunk_backlog_samples', 'Samples waiting in the LSL inlet (online mode).'))
+RECORDER_QUEUE = REGISTRY.register(Gauge(
+    'ekg_recorder_queue_depth', 'Chunks waiting in the session recorder queue.'))
+RECORDER_DROPPED = REGISTRY.register(Counter(
+    'ekg_recorder_dropped_chunks_total', 'Chunks dropped by the session recorder because its queue was full.'))
@@ -0,0 +1,149 @@
+from scipy import signal
+from filters import sosfilt_chunk
+import numpy as np
+
+class PanTompkinsDetector:
+    """Streaming R-peak detector based on the Pan-Tompkins algorithm.
+
+    Samples are pushed chunk by chunk with `process`; all filter states and thresholds are carried
+    between calls, so the cost of a call is proportional to the chunk length only. A beat is reported
+    as soon as the integrated QRS energy starts falling, i.e. roughly `integration_window` seconds after
+    the R-peak (beats recovered by the search-back can take up to 1.66 RR intervals).
+    """
+
+    def __init__(self, sampling_rate, band=(5, 15), integration_window=0.15, refractory=0.2, learning_time=2):
+        self.sampling_rate = sampling_rate
+        self.refractory = refractory
+        self.learning_samples = int(learning_time * sampling_rate)
+
+        # QRS enhancing band-pass followed by the five point derivative, as one cascade
+        sos_bp = signal.butter(2, band, btype='bandpass', output='sos', fs=sampling_rate)
+        sos_d = signal.tf2sos(np.array([2, 1, 0, -1, -2]) * sampling_rate / 8, [1])
+        self.sos = np.vstack((sos_bp, sos_d))
+
+        # Moving window integration
+        self.window_len = max(int(integration_window * sampling_rate), 1)
+
+        # Filtered signal kept for locating the R-peak inside the integration window
+        self.history_len = 2 * self.window_len + int(0.05 * sampling_rate)
+        self.reset()
+
+    def reset(self):
+        self.zi = np.zeros((1, self.sos.shape[0], 2))
+        self.squared_tail = np.zeros(self.window_len)
+
+        self.history_x = np.empty(0)
+        self.history_t = np.empty(0)
+        self.last_mwi = np.zeros(2)
+        self.samples_seen = 0
+        self.learning_mwi = []
+
+        # Running signal/noise peak estimates and thresholds
+        self.spki = 0.0
+        self.npki = 0.0
+        self.threshold_1 = 0.0
+        self.threshold_2 = 0.0
+
+        self.last_qrs_time = None
+        self.rr_average = None
+        self.candidates = [] # noise peaks since the last QRS, kept for the search-back
+
+    def process(self, x, t):
+        """Consumes a chunk of filtered samples `x` with timestamps `t`.
+        Returns the times and prominences of the R-peaks confirmed in this chunk."""
+        x = np.asarray(x, dtype=np.float64)
+        t = np.asarray(t, dtype=np.float64)
+        if x.size == 0:
+            return np.empty(0), np.empty(0)
+
+        d = sosfilt_chunk(self.sos, x, self.zi)
+
+        # Running sums over the squared derivative; only the last window of the previous chunk is needed
+        squared = np.concatenate((self.squared_tail, d * d))
+        cumulative = np.cumsum(squared)
+        mwi = (cumulative[self.window_len:] - cumulative[:-self.window_len]) / self.window_len
+        self.squared_tail = squared[-self.window_len:]
+
+        self.history_x = np.concatenate((self.history_x, x))[-self.history_len - x.size:]
+        self.history_t = np.concatenate((self.history_t, t))[-self.history_len - x.size:]
+
+        # Learning phase: thresholds initialised from the first seconds of the integrated signal
+        if self.samples_seen < self.learning_samples:
+            self.learning_mwi.append(mwi)
+            self.samples_seen += x.size
+            self.last_mwi = np.concatenate((self.last_mwi, mwi))[-2:]
+            if self.samples_seen >= self.learning_samples:
+                learned = np.concatenate(self.learning_mwi)
+                self.spki = 0.25 * np.max(learned)
+                self.npki = 0.5 * np.mean(learned)
+                self.update_thresholds()
+                self.learning_mwi = []
+            return np.empty(0), np.empty(0)
+        self.samples_seen += x.size
+
+        # Local maxima of the integrated signal, the last sample of the previous chunk included
+        extended = np.concatenate((self.last_mwi, mwi))
+        is_peak = (extended[1:-1] > extended[:-2]) & (extended[1:-1] >= extended[2:])
+        peak_indices = np.flatnonzero(is_peak) # index i in extended[1:-1] is sample i - 1 of this chunk
+        self.last_mwi = extended[-2:]
+
+        peaks_time, peaks_prominence = [], []
+        for i in peak_indices:
+            value = extended[i + 1]
+            chunk_index = i - 1
+            mwi_time = t[chunk_index] if chunk_index >= 0 else t[0] - 1 / self.sampling_rate
+            detected = self.classify(value, mwi_time, chunk_index - x.size)
+            for peak in detected:
+                peaks_time.append(peak[0])
+                peaks_prominence.append(peak[1])
+
+        return np.array(peaks_time), np.array(peaks_prominence)
+
+    def classify(self, value, mwi_time, offset):
+        """Applies the adaptive thresholds to one integrated-signal peak. `offset` is its (negative) index
+        relative to the end of the history. Returns a list of (time, prominence) of confirmed R-peaks."""
+        detected = []
+
+        # Search-back for a missed beat when no QRS appeared for 1.66 average RR intervals
+        if self.rr_average is not None and self.candidates and mwi_time - self.last_qrs_time > 1.66 * self.rr_average:
+            best = max(self.candidates, key=lambda c: c[0])
+            if best[0] > self.threshold_2:
+                self.spki = 0.25 * best[0] + 0.75 * self.spki
+                self.update_thresholds()
+                detected.append(self.accept(best[1], best[2], best[3]))
+
+        if self.last_qrs_time is not None and mwi_time - self.last_qrs_time < self.refractory:
+            return detected
+
+        r_time, r_prominence = self.locate_r_peak(offset)
+        if value > self.threshold_1:
+            self.spki = 0.125 * value + 0.875 * self.spki
+            self.update_thresholds()
+            detected.append(self.accept(mwi_time, r_time, r_prominence))
+        else:
+            self.npki = 0.125 * value + 0.875 * self.npki
+            self.update_thresholds()
+            self.candidates.append((value, mwi_time, r_time, r_prominence))
+        return detected
+
+    def accept(self, mwi_time, r_time, r_prominence):
+        if self.last_qrs_time is not None:
+            rr = mwi_time - self.last_qrs_time
+            self.rr_average = rr if self.rr_average is None else 0.125 * rr + 0.875 * self.rr_average
+        self.last_qrs_time = mwi_time
+        self.candidates = []
+        return r_time, r_prominence
+
+    def locate_r_peak(self, offset):
+        # The R-peak precedes the maximum of the integrated signal by up to one integration window
+        end = len(self.history_x) + offset + 1
+        start = max(end - self.window_len - int(0.05 * self.sampling_rate), 0)
+        segment = self.history_x[start:end]
+        if segment.size == 0:
+            return self.history_t[-1], 0.0
+        r_index = np.argmax(segment)
+        return self.history_t[start + r_index], segment[r_index] - np.min(segment)
+
+    def update_thresholds(self):
+        self.threshold_1 = self.npki + 0.25 * (self.spki - self.npki)
+        self.threshold_2 = 0.5 * self.threshold_1
@@ -0,0 +1,171 @@
+import datetime
+import json
+import queue
+import threading
+import time
+import h5py
+import numpy as np
+import metrics
+
+class SessionRecorder:
+    """Records a session to an HDF5 file: raw and filtered samples with their timestamps from the
+    SignalProcessor, and R-peaks with RR intervals from the PeaksDetector.
+
+    The processing threads only put the chunks into a bounded queue. A separate writer thread appends
+    them to chunked, compressed, resizable datasets, so disk I/O never blocks the acquisition. When
+    the queue is full the chunk is dropped and counted in `dropped_chunks`."""
+
+    def __init__(self, path, signal_processor, peaks_detector=None, queue_size=1024, chunk_rows=4096,
+                 compression='gzip', compression_level=4, flush_interval=1.0):
+        self.path = path
+        self.signal_processor = signal_processor
+        self.peaks_detector = peaks_detector
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.compression_level = compression_level
+        self.flush_interval = flush_interval
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped_chunks = 0
+        self.written_chunks = 0
+        self.max_queue_depth = 0
+        self.stats_lock = threading.Lock() # put is called from the acquisition and the peaks threads
+
+        self.file = None
+        self.datasets = {}
+        self.running = False
+
+    def create_datasets(self):
+        n_leads = self.signal_processor.n_leads
+        lead_shape = () if self.signal_processor.leads is None else (n_leads,)
+        signals = {
+            'raw': (lead_shape, np.float32, self.chunk_rows),
+            'filtered': (lead_shape, np.float32, self.chunk_rows),
+            'time': ((), np.float64, self.chunk_rows),
+            'peaks_time': ((), np.float64, 256),
+            'peaks_prominence': ((), np.float64, 256),
+            'rr_intervals': ((), np.float64, 256),
+        }
+        for name, (shape, dtype, rows) in signals.items():
+            self.datasets[name] = self.file.create_dataset(
+                name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype, chunks=(rows,) + shape,
+                compression=self.compression, compression_opts=self.compression_level, shuffle=True)
+
+        attrs = self.file.attrs
+        attrs['sampling_rate'] = self.signal_processor.sampling_rate
+        attrs['mode'] = self.signal_processor.mode
+        # The recorded leads: channel indices or (channel, reference) pairs, null when not known
+        attrs['channels'] = json.dumps(self.recorded_channels())
+        attrs['leads'] = json.dumps(self.signal_processor.leads)
+        attrs['filters'] = json.dumps({'hp': self.signal_processor.hp_params,
+                                       'lp': self.signal_processor.lp_params,
+                                       'notch': self.signal_processor.notch_params})
+        attrs['start_time'] = datetime.datetime.now().isoformat()
+
+    def recorded_channels(self):
+        processor = self.signal_processor
+        if processor.leads is not None:
+            return processor.leads
+        return None if processor.channel is None else [processor.channel]
+
+    def put(self, kind, arrays):
+        try:
+            self.queue.put_nowait((kind, arrays))
+        except queue.Full:
+            with self.stats_lock:
+                self.dropped_chunks += 1
+            return
+        depth = self.queue.qsize()
+        with self.stats_lock:
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+
+    def record_samples(self, new_data, filtered_data, time_data):
+        # Online the raw chunk is a view of the pull buffer, so it is copied before the next pull
+        self.put('samples', (np.array(new_data, dtype=np.float32),
+                             np.array(filtered_data, dtype=np.float32),
+                             time_data))
+
+    def record_peaks(self, peaks, prominences, rr_intervals):
+        self.put('peaks', (np.array(peaks, dtype=np.float64),
+                           np.array(prominences, dtype=np.float64),
+                           np.array(rr_intervals, dtype=np.float64)))
+
+    def append(self, name, values):
+        if not len(values):
+            return
+        dataset = self.datasets[name]
+        n = dataset.shape[0]
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
+
+    def write(self, items):
+        # One resize and write per dataset for everything taken from the queue at once
+        samples = [arrays for kind, arrays in items if kind == 'samples']
+        peaks = [arrays for kind, arrays in items if kind == 'peaks']
+        for i, name in enumerate(('raw', 'filtered', 'time')):
+            if samples:
+                self.append(name, np.concatenate([arrays[i] for arrays in samples]))
+        for i, name in enumerate(('peaks_time', 'peaks_prominence', 'rr_intervals')):
+            if peaks:
+                self.append(name, np.concatenate([arrays[i] for arrays in peaks]))
+        self.written_chunks += len(items)
+
+    def writer_thread(self):
+        last_flush = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                items = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in items:
+                stopping = True
+                items = [item for item in items if item is not None]
+            if items:
+                self.write(items)
+
+            # Regular flushes keep the file readable if the application is killed
+            now = time.monotonic()
+            if now - last_flush > self.flush_interval:
+                self.file.flush()
+                last_flush = now
+
+    def get_stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'dropped_chunks': self.dropped_chunks,
+            'written_chunks': self.written_chunks,
+        }
+
+    def start(self):
+        if not self.running:
+            self.file = h5py.File(self.path, 'w')
+            self.create_datasets()
+            self.running = True
+            # A daemon thread does not keep a crashed application alive, the file is flushed regularly anyway
+            self.thread = threading.Thread(target=self.writer_thread, daemon=True)
+            self.thread.start()
+            self.signal_processor.add_listener(self.record_samples)
+            if self.peaks_detector is not None:
+                self.peaks_detector.add_peak_listener(self.record_peaks)
+            metrics.RECORDER_QUEUE.set_function(self.queue.qsize)
+            metrics.RECORDER_DROPPED.set_function(lambda: self.dropped_chunks)
+
+    def stop(self):
+        if self.running:
+            self.signal_processor.remove_listener(self.record_samples)
+            if self.peaks_detector is not None:
+                self.peaks_detector.remove_peak_listener(self.record_peaks)
+            self.running = False
+            # The end marker is queued behind all the recorded chunks
+            self.queue.put(None)
+            self.thread.join()
+            self.file.attrs['dropped_chunks'] = self.dropped_chunks
+            self.file.close()
@@ -0,0 +1,43 @@
+import threading
+import time
+import metrics
+
+class RenderCache:
+    """Figures shared by all the dashboard clients, one entry per chart.
+
+    get() returns the cached figure while its `key` (the settings the figure depends on) is unchanged
+    and either the data `version` is the same or the figure is younger than `max_age` seconds. Otherwise
+    the figure is rebuilt once: clients asking for it at the same time wait for that build instead of
+    building their own copy. The figures are shared, so they must not be modified by the callers."""
+
+    def __init__(self, max_age=0.0):
+        self.max_age = max_age
+        self.entries = {} # name -> (key, version, build time, figure)
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def fresh(self, entry, key, version):
+        return (entry is not None and entry[0] == key
+                and (entry[1] == version or time.monotonic() - entry[2] < self.max_age))
+
+    def get(self, name, key, version, build):
+        entry = self.entries.get(name)
+        if self.fresh(entry, key, version):
+            metrics.RENDER_CACHE.labels(name, 'hit').inc()
+            return entry[3]
+
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        with lock:
+            # Another client may have built the figure while this one was waiting
+            entry = self.entries.get(name)
+            if self.fresh(entry, key, version):
+                metrics.RENDER_CACHE.labels(name, 'hit').inc()
+                return entry[3]
+            figure = build()
+            self.entries[name] = (key, version, time.monotonic(), figure)
+        metrics.RENDER_CACHE.labels(name, 'miss').inc()
+        return figure
+
+    def clear(self):
+        self.entries.clear()
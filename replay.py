@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+import numpy as np
+
+class ReplaySource:
+    """Random-access replay of a recorded session, used by the SignalProcessor in offline mode in place
+    of the test_signal generator. Plays a .raw file (memory-mapped) or an HDF5 file written by
+    SessionRecorder (read a block at a time), so only the replayed part of the file is decoded.
+
+    Every item is (samples, timestamps, pre_roll) with the recording's own time axis. After a seek,
+    pre_roll holds up to `pre_roll` seconds of samples preceding the new position, which the
+    SignalProcessor runs through its filters before adding the data; otherwise it is None.
+    `speed` is the playback speed relative to real time, 0 plays as fast as possible."""
+
+    def __init__(self, path, fs=500, n_ch=1, dtype='<f', channel=None, channel_base=-1, chunk_size=16,
+                 scale=0.0715, speed=1.0, start=0.0, events=None, pre_roll=2.0):
+        self.channel = channel
+        self.channel_base = channel_base
+        self.chunk_size = chunk_size
+        self.pre_roll = pre_roll
+
+        if os.path.splitext(path)[1] in ('.h5', '.hdf5'):
+            import h5py
+            self.file = h5py.File(path, 'r')
+            self.signal = self.file['raw']
+            self.time = self.file['time']
+            self.fs = int(self.file.attrs['sampling_rate'])
+            self.scale = 1.0 # the recorder stores the samples as they entered the SignalProcessor
+            # Sparse time index: the timestamp of the first sample of every HDF5 chunk
+            self.index_step = self.time.chunks[0]
+            self.index_time = self.time[::self.index_step]
+            self.block_size = max(self.index_step, chunk_size)
+        else:
+            self.file = None
+            s = np.asarray(np.memmap(path, dtype=dtype, mode='r'))
+            if n_ch != 1:
+                n_samples = len(s) // n_ch
+                s = s[:n_samples * n_ch].reshape((n_samples, n_ch))
+            self.signal = s
+            self.time = None
+            self.fs = fs
+            self.scale = scale
+        self.n_samples = len(self.signal)
+
+        # Recorded leads are replayed as they are, e.g. for SignalProcessor(channels=range(n_leads))
+        self.n_leads = None
+        if self.file is not None and self.signal.ndim == 2:
+            self.n_leads = self.signal.shape[1]
+
+        self.block_start = 0
+        self.block_samples = None
+        self.block_time = None
+
+        self.events = np.sort(np.asarray(events if events is not None else [], dtype=np.float64))
+        self.speed = speed
+        self.position = 0
+        self.seeked = False
+        self.deadline = None
+        self.lock = threading.Lock()
+        if start:
+            self.seek(start)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            start = self.position
+            if start >= self.n_samples:
+                print("End of signal reached")
+                raise StopIteration
+            stop = min(start + self.chunk_size, self.n_samples)
+            pre_roll = None
+            if self.seeked:
+                pre_roll, _ = self.read(max(start - int(self.pre_roll * self.fs), 0), start)
+                self.seeked = False
+            self.position = stop
+            speed = self.speed
+
+        samples, timestamps = self.read(start, stop)
+
+        # Pacing against a deadline, so the sleep granularity does not accumulate into a drift
+        if speed:
+            now = time.monotonic()
+            if self.deadline is None or self.deadline < now - 1:
+                self.deadline = now
+            self.deadline += (stop - start) / (self.fs * speed)
+            time.sleep(max(self.deadline - now, 0))
+        return samples, timestamps, pre_roll
+
+    def read(self, start, stop):
+        if self.file is not None and stop - start <= self.block_size:
+            # HDF5 reads have a large fixed cost, so the chunks are served from a block read ahead
+            if self.block_samples is None or start < self.block_start or stop > self.block_start + len(self.block_samples):
+                self.block_start = start
+                end = min(start + self.block_size, self.n_samples)
+                self.block_samples = self.signal[start:end]
+                self.block_time = self.time[start:end]
+            i, j = start - self.block_start, stop - self.block_start
+            samples, timestamps = self.block_samples[i:j], self.block_time[i:j]
+        elif self.file is not None:
+            samples, timestamps = self.signal[start:stop], self.time[start:stop]
+        else:
+            samples = self.signal[start:stop]
+            timestamps = (np.arange(start, stop) + 1) / self.fs
+
+        if self.n_leads is None and samples.ndim == 2 and self.channel is not None:
+            if self.channel_base == -1:
+                samples = samples[:, self.channel]
+            else:
+                samples = samples[:, self.channel] - samples[:, self.channel_base]
+        return samples * self.scale, timestamps
+
+    def index_of(self, t):
+        """Index of the first sample with a timestamp not earlier than `t`."""
+        if self.time is None:
+            index = int(np.ceil(t * self.fs - 1e-9)) - 1
+        else:
+            k = max(np.searchsorted(self.index_time, t, side='right') - 1, 0)
+            chunk = self.time[k * self.index_step:(k + 1) * self.index_step]
+            index = k * self.index_step + int(np.searchsorted(chunk, t))
+        return min(max(index, 0), self.n_samples)
+
+    def time_of(self, index):
+        index = min(max(index, 0), self.n_samples - 1)
+        if self.time is None:
+            return (index + 1) / self.fs
+        return float(self.time[index])
+
+    def get_time(self):
+        """Timestamp of the next sample to be played."""
+        with self.lock:
+            return self.time_of(self.position)
+
+    def get_duration(self):
+        return self.time_of(self.n_samples - 1)
+
+    def seek(self, t):
+        index = self.index_of(t)
+        with self.lock:
+            self.position = index
+            self.seeked = True
+            self.deadline = None
+
+    def set_speed(self, speed):
+        with self.lock:
+            self.speed = speed
+            self.deadline = None
+
+    def next_event(self):
+        """Jumps to the first event after the current position, returns its time or None."""
+        t = self.get_time()
+        later = self.events[self.events > t]
+        if not later.size:
+            return None
+        self.seek(later[0])
+        return later[0]
+
+    def previous_event(self):
+        """Jumps to the last event more than a second before the current position, returns its time or None."""
+        t = self.get_time()
+        earlier = self.events[self.events < t - 1]
+        if not earlier.size:
+            return None
+        self.seek(earlier[-1])
+        return earlier[-1]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,47 @@
+import numpy as np
+
+class RingBuffer:
+    """Fixed-size NumPy ring buffer. Writes are bulk copies into preallocated memory,
+    reads return the stored samples as one contiguous array in chronological order."""
+
+    def __init__(self, capacity, channels=None, dtype=np.float64):
+        self.capacity = capacity
+        self.channels = channels
+        shape = (capacity,) if channels is None else (capacity, channels)
+        self.buffer = np.zeros(shape, dtype=dtype)
+        self.written = 0 # total number of samples written since the last clear
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.buffer.dtype)
+        n = len(values)
+        if n == 0:
+            return
+
+        # Only the newest `capacity` samples can survive the write
+        if n > self.capacity:
+            values = values[-self.capacity:]
+        k = len(values)
+
+        start = (self.written + n - k) % self.capacity
+        first = min(k, self.capacity - start)
+        self.buffer[start:start + first] = values[:first]
+        self.buffer[:k - first] = values[first:]
+        self.written += n
+
+    def snapshot(self, n=None, channel=None):
+        """Copy of the newest n samples (all stored samples by default), oldest first.
+        For a multi-channel buffer `channel` selects a single column."""
+        count = len(self) if n is None else min(n, len(self))
+        end = self.written % self.capacity
+        start = (end - count) % self.capacity
+        buffer = self.buffer if channel is None else self.buffer[:, channel]
+
+        if start + count <= self.capacity:
+            return buffer[start:start + count].copy()
+        return np.concatenate((buffer[start:], buffer[:end]))
+
+    def clear(self):
+        self.written = 0
@@ -1,25 +1,27 @@
 import numpy as np
 import time
 
-def signal_generator(s, channel, channel_base, fs, chunk_size):
-    try:
-        for i in range(0, len(s[:]), chunk_size):
+def signal_generator(s, channel, channel_base, fs, chunk_size, scale=0.0715, realtime=True):
+    # Scaling and re-referencing are done on the yielded chunk only, `s` is never read as a whole
+    for i in range(0, len(s), chunk_size):
+        if realtime:
             time.sleep(chunk_size / fs)
 
-            if channel_base == -1:
-                if channel == 0:
-                    syg = s
-                else:
-                    syg = s[:, channel]
-            else:
-                syg = s[:, channel] - s[:, channel_base]
-            yield syg[i:i+chunk_size]
-    except StopIteration:
-        print("End of signal reached")
+        chunk = s[i:i+chunk_size]
+        if channel is None or chunk.ndim == 1:
+            syg = chunk
+        elif channel_base == -1:
+            syg = chunk[:, channel]
+        else:
+            syg = chunk[:, channel] - chunk[:, channel_base]
+        yield syg * scale
+    print("End of signal reached")
 
-def test_signal(s_path, n_ch=1, dtype='<f', channel=None, channel_base=None, fs=500, chunk_size=16):
-    s = np.fromfile(s_path, dtype=dtype)
-    s = s * 0.0715
+def test_signal(s_path, n_ch=1, dtype='<f', channel=None, channel_base=None, fs=500, chunk_size=16, realtime=True):
+    # The recording is memory-mapped, so files larger than RAM can be replayed. A plain ndarray view
+    # of the map avoids the memmap subclass overhead on every chunk slice.
+    s = np.asarray(np.memmap(s_path, dtype=dtype, mode='r'))
     if n_ch != 1:
-        s = np.reshape(s, (len(s)//n_ch, n_ch))
-    return signal_generator(s, channel, channel_base, fs, chunk_size)
\ No newline at end of file
+        n_samples = len(s) // n_ch
+        s = s[:n_samples * n_ch].reshape((n_samples, n_ch))
+    return signal_generator(s, channel, channel_base, fs, chunk_size, realtime=realtime)